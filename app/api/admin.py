@@ -1,12 +1,19 @@
 import aiohttp
 from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from app.deps import require_admin
+from app.responses import FastJSONResponse
+from app.cache import entitlement_cache
+from app.db import pool_stats
 from app.services.storage import (
     create_package, list_packages, create_user, list_users,
-    assign_package_to_user, save_playlist_for_package, get_latest_playlist_for_package
+    assign_package_to_user, save_playlist_for_package, get_latest_playlist_for_package,
+    get_playlist,
 )
-from app.services.epg_service import refresh_epg_for_playlist
+from app.services import epg_index
+from app.services.epg_service import refresh_epg_for_playlist, epg_progress
+from app.services.scheduler import epg_source_stats
 
 router = APIRouter(dependencies=[Depends(require_admin)])
 
@@ -36,7 +43,7 @@ def create_pkg(req: PackageReq):
 
 @router.get("/packages")
 def get_pkgs():
-    return {"items": list_packages()}
+    return FastJSONResponse({"items": list_packages()})
 
 @router.post("/users")
 def create_usr(req: UserReq):
@@ -44,7 +51,7 @@ def create_usr(req: UserReq):
 
 @router.get("/users")
 def get_users():
-    return {"items": list_users()}
+    return FastJSONResponse({"items": list_users()})
 
 @router.post("/users/{user_id}/packages/{package_id}")
 def assign_pkg(user_id: str, package_id: str):
@@ -57,8 +64,9 @@ async def upload_playlist(package_id: str, file: UploadFile = File(...), refresh
         text = raw.decode("utf-8")
     except UnicodeDecodeError:
         text = raw.decode("cp1251", errors="ignore")
-    meta = save_playlist_for_package(text, package_id, "file", file.filename or "upload")
-    if refresh_epg and meta.get("epg_url"):
+    # parse + channel delta + catalog compression: seconds on a big playlist, keep it off the loop
+    meta = await run_in_threadpool(save_playlist_for_package, text, package_id, "file", file.filename or "upload")
+    if refresh_epg and meta.get("epg_url") and not meta["unchanged"]:
         try:
             meta["epg"] = {"refreshed": True, **(await refresh_epg_for_playlist(meta["playlist_id"], meta["epg_url"]))}
         except Exception as e:
@@ -82,8 +90,8 @@ async def playlist_from_url(package_id: str, req: FromUrlReq, refresh_epg: bool
         text = raw.decode("utf-8")
     except UnicodeDecodeError:
         text = raw.decode("cp1251", errors="ignore")
-    meta = save_playlist_for_package(text, package_id, "url", url)
-    if refresh_epg and meta.get("epg_url"):
+    meta = await run_in_threadpool(save_playlist_for_package, text, package_id, "url", url)
+    if refresh_epg and meta.get("epg_url") and not meta["unchanged"]:
         try:
             meta["epg"] = {"refreshed": True, **(await refresh_epg_for_playlist(meta["playlist_id"], meta["epg_url"]))}
         except Exception as e:
@@ -92,4 +100,29 @@ async def playlist_from_url(package_id: str, req: FromUrlReq, refresh_epg: bool
 
 @router.get("/packages/{package_id}/playlist/latest")
 def latest_playlist(package_id: str):
-    return {"item": get_latest_playlist_for_package(package_id)}
+    return FastJSONResponse({"item": get_latest_playlist_for_package(package_id)})
+
+@router.post("/playlists/{playlist_id}/epg/refresh")
+async def refresh_playlist_epg(playlist_id: str):
+    pl = get_playlist(playlist_id)
+    if not pl:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    if not pl.get("epg_url"):
+        raise HTTPException(status_code=400, detail="Playlist has no url-tvg")
+    return await refresh_epg_for_playlist(playlist_id, pl["epg_url"])
+
+@router.get("/epg/progress")
+def epg_refresh_progress():
+    return {"items": epg_progress()}
+
+@router.get("/epg/sources")
+def epg_sources():
+    return {"items": epg_source_stats()}
+
+@router.get("/stats/cache")
+def cache_stats():
+    return {"entitlements": entitlement_cache.stats(), "epg_index": epg_index.stats()}
+
+@router.get("/stats/db")
+def db_stats():
+    return pool_stats()
@@ -4,10 +4,11 @@ from datetime import datetime, timezone
 
 import stripe
 from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, EmailStr
 from sqlalchemy import text
 
-from app.db import db
+from app.db import db, unit_of_work
 from app.services.storage import (
     get_package,
     create_or_get_user_for_email,
@@ -80,28 +81,36 @@ def create_checkout(req: CheckoutReq):
     return {"checkout_url": session["url"], "session_id": session["id"]}
 
 
-@router.post("/stripe/webhook")
-async def stripe_webhook(request: Request):
-    payload = await request.body()
-    sig_header = request.headers.get("stripe-signature", "")
-    wh_secret = os.getenv("STRIPE_WEBHOOK_SECRET", "").strip()
-    if not wh_secret:
-        raise HTTPException(status_code=500, detail="STRIPE_WEBHOOK_SECRET is not set")
-
-    st = _stripe()
-
+def _retrieve_subscription(st, subscription_id: str | None):
+    if not subscription_id:
+        return None
     try:
-        event = st.Webhook.construct_event(payload=payload, sig_header=sig_header, secret=wh_secret)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Webhook signature verification failed: {e}")
+        return st.Subscription.retrieve(subscription_id)
+    except Exception:
+        return None
 
+def _handle_event(st, event, payload: bytes) -> None:
     etype = event["type"]
     obj = event["data"]["object"]
 
+    # Stripe API calls first, so no transaction is held open across them
+    sub = None
+    if etype in ("checkout.session.completed", "invoice.paid", "invoice.payment_succeeded"):
+        sub = _retrieve_subscription(st, obj.get("subscription"))
+
+    # every storage helper below joins this one transaction: one checkout, one commit,
+    # and a failure rolls the whole event back (Stripe then retries it)
+    with unit_of_work():
+        _apply_event(event, obj, sub, payload)
+
+def _apply_event(event, obj, sub, payload: bytes) -> None:
+    etype = event["type"]
+
     # Helper to persist payment event
     def _save_payment(user_id: str | None):
         try:
-            with db() as conn:
+            # savepoint: a failed insert must not abort the surrounding unit of work
+            with db() as conn, conn.begin_nested():
                 conn.execute(text("""
                     INSERT INTO payments(
                         id, user_id, provider, event_type, stripe_event_id,
@@ -143,17 +152,13 @@ async def stripe_webhook(request: Request):
 
         if customer_id and subscription_id:
             set_user_stripe(customer_id, subscription_id, user_id=user_id)
-        # fetch subscription to get period end
-        try:
-            sub = st.Subscription.retrieve(subscription_id)
+        # subscription gives the period end
+        if sub and user_id:
             paid_until = datetime.fromtimestamp(sub["current_period_end"], tz=timezone.utc)
-            if user_id:
-                update_subscription_state(user_id, "active", paid_until)
-                if package_id:
-                    set_user_current_package(user_id, package_id)
-                    assign_package_to_user(user_id, package_id, active_until=paid_until)
-        except Exception:
-            pass
+            update_subscription_state(user_id, "active", paid_until)
+            if package_id:
+                set_user_current_package(user_id, package_id)
+                assign_package_to_user(user_id, package_id, active_until=paid_until)
 
     elif etype in ("invoice.paid", "invoice.payment_succeeded"):
         customer_id = obj.get("customer")
@@ -164,17 +169,13 @@ async def stripe_webhook(request: Request):
             user = get_user_by_stripe_customer(customer_id)
         if user:
             user_id = user["id"]
-            try:
-                sub = st.Subscription.retrieve(subscription_id) if subscription_id else None
-                if sub:
-                    paid_until = datetime.fromtimestamp(sub["current_period_end"], tz=timezone.utc)
-                    update_subscription_state(user_id, "active", paid_until)
-                    pkg = (sub.get("metadata") or {}).get("package_id") or user.get("current_package_id")
-                    if pkg:
-                        set_user_current_package(user_id, pkg)
-                        assign_package_to_user(user_id, pkg, active_until=paid_until)
-            except Exception:
-                pass
+            if sub:
+                paid_until = datetime.fromtimestamp(sub["current_period_end"], tz=timezone.utc)
+                update_subscription_state(user_id, "active", paid_until)
+                pkg = (sub.get("metadata") or {}).get("package_id") or user.get("current_package_id")
+                if pkg:
+                    set_user_current_package(user_id, pkg)
+                    assign_package_to_user(user_id, pkg, active_until=paid_until)
 
     elif etype == "invoice.payment_failed":
         customer_id = obj.get("customer")
@@ -208,4 +209,22 @@ async def stripe_webhook(request: Request):
 
     _save_payment(user_id)
 
+
+@router.post("/stripe/webhook")
+async def stripe_webhook(request: Request):
+    payload = await request.body()
+    sig_header = request.headers.get("stripe-signature", "")
+    wh_secret = os.getenv("STRIPE_WEBHOOK_SECRET", "").strip()
+    if not wh_secret:
+        raise HTTPException(status_code=500, detail="STRIPE_WEBHOOK_SECRET is not set")
+
+    st = _stripe()
+
+    try:
+        event = st.Webhook.construct_event(payload=payload, sig_header=sig_header, secret=wh_secret)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Webhook signature verification failed: {e}")
+
+    # DB work is blocking: run it in the threadpool, not on the event loop
+    await run_in_threadpool(_handle_event, st, event, payload)
     return {"ok": True}
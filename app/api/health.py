@@ -1,7 +1,9 @@
 from fastapi import APIRouter
-from app.db import init_db
+from sqlalchemy import text
+from app.db import db
 router = APIRouter()
 @router.get("/health")
 def health():
-    init_db()
+    with db() as conn:
+        conn.execute(text("SELECT 1"))
     return {"status":"ok"}
@@ -1,19 +1,40 @@
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import datetime, timezone, timedelta
+from typing import Iterator, List
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from sqlalchemy import text
 from app.deps import require_user
-from app.db import db
-from app.services.storage import get_active_playlists_for_user, list_groups_for_playlists, list_channels_for_playlists
-from app.services.epg_service import now_next_for_playlists
+from app.etag import make_etag, etag_matches, not_modified, etag_headers
+from app.responses import FastJSONResponse, dumps
+from app.db import adb
+from app.services.storage import (
+    list_groups_for_playlists, list_channels_for_playlists, list_tvg_ids_for_group,
+    list_groups_for_playlists_async, list_channels_for_playlists_async, list_channels_page_async,
+)
+from app.services.epg_service import now_next_for_playlists_async, now_next_batch_async, iter_grid
+from app.services.catalog import choose_encoding, get_catalog_snapshot
 
 router = APIRouter()
 
+# query-path cap for /catalog when it can't be served from a snapshot
+_CATALOG_MAX_ITEMS = 100000
+# /epg/grid limits
+_GRID_MAX_HOURS = 48
+_GRID_MAX_CHANNELS = 500
+# programmes per streamed chunk
+_GRID_CHUNK_ROWS = 500
+
+# the hot read paths are async and go through the asyncpg engine (adb), so they don't
+# hold a threadpool thread while waiting on Postgres
 @router.get("/me")
-def me(user=Depends(require_user)):
-    with db() as conn:
-        u = conn.execute(text("SELECT id, email, status, paid_until, current_package_id FROM users WHERE id=:id"), {"id": user["user_id"]}).mappings().first()
+async def me(user=Depends(require_user)):
+    async with adb() as conn:
+        u = (await conn.execute(text("SELECT id, email, status, paid_until, current_package_id FROM users WHERE id=:id"), {"id": user["user_id"]})).mappings().first()
         pkg = None
         if u and u.get("current_package_id"):
-            pkg = conn.execute(text("SELECT id, name, price_cents, currency FROM packages WHERE id=:id"), {"id": u["current_package_id"]}).mappings().first()
+            pkg = (await conn.execute(text("SELECT id, name, price_cents, currency FROM packages WHERE id=:id"), {"id": u["current_package_id"]})).mappings().first()
     return {
         "user_id": user["user_id"],
         "email": u.get("email") if u else None,
@@ -23,21 +44,129 @@ def me(user=Depends(require_user)):
     }
 
 @router.get("/groups")
-def groups(user=Depends(require_user)):
-    pls = get_active_playlists_for_user(user["user_id"])
-    ids = [p["id"] for p in pls]
-    return {"groups": list_groups_for_playlists(ids)}
+async def groups(request: Request, user=Depends(require_user)):
+    etag = make_etag("groups", user["catalog_rev"])
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    ids = user["playlist_ids"]
+    return FastJSONResponse({"groups": await list_groups_for_playlists_async(ids)}, headers=etag_headers(etag))
 
 @router.get("/channels")
-def channels(group: str | None = None, search: str | None = None, limit: int = 5000, user=Depends(require_user)):
-    pls = get_active_playlists_for_user(user["user_id"])
-    ids = [p["id"] for p in pls]
-    return {"group": group, "search": search, "items": list_channels_for_playlists(ids, group=group, search=search, limit=limit)}
+async def channels(request: Request, group: str | None = None, search: str | None = None,
+             cursor: str | None = None, limit: int = Query(default=200, ge=1, le=1000), user=Depends(require_user)):
+    etag = make_etag("channels", user["catalog_rev"], group, search, cursor, limit)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    ids = user["playlist_ids"]
+    if search:
+        # ranked results: a single page, no continuation
+        return FastJSONResponse({"group": group, "search": search, "next_cursor": None,
+                                 "items": await list_channels_for_playlists_async(ids, group=group, search=search, limit=limit)},
+                                headers=etag_headers(etag))
+    try:
+        items, next_cursor = await list_channels_page_async(ids, group=group, cursor=cursor, limit=limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return FastJSONResponse({"group": group, "search": search, "next_cursor": next_cursor, "items": items},
+                            headers=etag_headers(etag))
+
+@router.get("/catalog")
+def catalog(request: Request, group: str | None = None, user=Depends(require_user)):
+    """
+    Full channel catalog + groups. A single unfiltered playlist is served as the
+    precompressed snapshot built at ingest; anything else goes through the query path.
+    """
+    ids = user["playlist_ids"]
+    if group or len(ids) != 1:
+        etag = make_etag("catalog", user["catalog_rev"], group)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        return FastJSONResponse({
+            "playlist_id": ids[0] if len(ids) == 1 else None,
+            "groups": list_groups_for_playlists(ids),
+            "items": list_channels_for_playlists(ids, group=group, limit=_CATALOG_MAX_ITEMS),
+        }, headers=etag_headers(etag))
+
+    pid = ids[0]
+    version = user["playlist_versions"][pid]
+    encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    etag = make_etag("catalog", pid, version, encoding)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    snap = get_catalog_snapshot(pid, version)
+    headers = {**etag_headers(etag), "Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=snap.body(encoding), media_type="application/json", headers=headers)
 
 @router.get("/epg/now_next/{tvg_id}")
-def epg_now_next(tvg_id: str, user=Depends(require_user)):
-    pls = get_active_playlists_for_user(user["user_id"])
-    ids = [p["id"] for p in pls]
+async def epg_now_next(tvg_id: str, user=Depends(require_user)):
+    ids = user["playlist_ids"]
+    if not ids:
+        raise HTTPException(status_code=403, detail="No active playlists for this user")
+    return FastJSONResponse(await now_next_for_playlists_async(ids, tvg_id))
+
+class NowNextBatchReq(BaseModel):
+    tvg_ids: List[str] = Field(..., min_length=1, max_length=500)
+
+@router.post("/epg/now_next")
+async def epg_now_next_batch(req: NowNextBatchReq, user=Depends(require_user)):
+    ids = user["playlist_ids"]
     if not ids:
         raise HTTPException(status_code=403, detail="No active playlists for this user")
-    return now_next_for_playlists(ids, tvg_id)
+    return FastJSONResponse({"items": await now_next_batch_async(ids, req.tvg_ids)})
+
+def _utc(dt: datetime) -> datetime:
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+def _ndjson(items: Iterator[dict]) -> Iterator[bytes]:
+    buf = []
+    for it in items:
+        buf.append(dumps(it))
+        if len(buf) >= _GRID_CHUNK_ROWS:
+            yield b"\n".join(buf) + b"\n"
+            buf = []
+    if buf:
+        yield b"\n".join(buf) + b"\n"
+
+def _json_array(items: Iterator[dict]) -> Iterator[bytes]:
+    yield b'{"items":['
+    sep = b""
+    buf = []
+    for it in items:
+        buf.append(sep + dumps(it))
+        sep = b","
+        if len(buf) >= _GRID_CHUNK_ROWS:
+            yield b"".join(buf)
+            buf = []
+    buf.append(b"]}")
+    yield b"".join(buf)
+
+@router.get("/epg/grid")
+def epg_grid(start: datetime, stop: datetime, tvg_id: List[str] = Query(default=[]), group: str | None = None,
+             format: str = Query(default="ndjson", pattern="^(ndjson|json)$"), user=Depends(require_user)):
+    """
+    All programmes overlapping [start, stop) for the given channels (tvg_id=...&tvg_id=...)
+    or for a whole group, streamed as NDJSON (one programme per line) or as one chunked JSON object.
+    """
+    ids = user["playlist_ids"]
+    if not ids:
+        raise HTTPException(status_code=403, detail="No active playlists for this user")
+    start, stop = _utc(start), _utc(stop)
+    if stop <= start:
+        raise HTTPException(status_code=400, detail="stop must be after start")
+    if stop - start > timedelta(hours=_GRID_MAX_HOURS):
+        raise HTTPException(status_code=400, detail=f"Window is limited to {_GRID_MAX_HOURS} hours")
+    if tvg_id:
+        if len(tvg_id) > _GRID_MAX_CHANNELS:
+            raise HTTPException(status_code=400, detail=f"At most {_GRID_MAX_CHANNELS} channels per request")
+        tvg_ids = tvg_id
+    elif group:
+        tvg_ids = list_tvg_ids_for_group(ids, group)
+    else:
+        raise HTTPException(status_code=400, detail="tvg_id or group is required")
+
+    items = iter_grid(ids, tvg_ids, start, stop)
+    if format == "json":
+        return StreamingResponse(_json_array(items), media_type="application/json")
+    return StreamingResponse(_ndjson(items), media_type="application/x-ndjson")
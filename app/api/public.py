@@ -1,10 +1,18 @@
-from fastapi import APIRouter
-from app.services.storage import list_packages
+from fastapi import APIRouter, Request
+from app.etag import make_etag, etag_matches, not_modified, etag_headers
+from app.responses import FastJSONResponse
+from app.services.storage import list_packages, packages_version
 
 router = APIRouter()
 
 @router.get("/packages")
-def packages():
+def packages(request: Request):
+    etag = make_etag("packages", packages_version())
+    if etag_matches(request, etag):
+        return not_modified(etag, private=False)
     items = list_packages()
     # do not expose stripe_price_id to the app if you don't want (but app needs it only for checkout via backend)
-    return {"items": [{"id": p["id"], "name": p["name"], "price_cents": p["price_cents"], "currency": p["currency"]} for p in items]}
+    return FastJSONResponse(
+        {"items": [{"id": p["id"], "name": p["name"], "price_cents": p["price_cents"], "currency": p["currency"]} for p in items]},
+        headers=etag_headers(etag, private=False),
+    )
@@ -1,18 +1,24 @@
+import asyncio
+import io
 import os
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
 
 from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+
+from app.dbstats import TimedAsyncQueuePool, TimedQueuePool, db_stats, instrument, pool_status
 
 
 _engine: Engine | None = None
+_async_engine: AsyncEngine | None = None
+# open unit of work in this context: its connection + callbacks to run after commit
+_unit: ContextVar[Optional[Tuple[Connection, List[Callable[[], None]]]]] = ContextVar("db_unit", default=None)
 
 
-def _get_engine() -> Engine:
-    global _engine
-    if _engine is not None:
-        return _engine
-
+def _database_url() -> str:
     database_url = os.getenv("DATABASE_URL", "").strip()
     if not database_url:
         raise RuntimeError("DATABASE_URL is not set")
@@ -20,89 +26,244 @@ def _get_engine() -> Engine:
     # Render Postgres URL may be 'postgres://', SQLAlchemy prefers 'postgresql://'
     if database_url.startswith("postgres://"):
         database_url = "postgresql://" + database_url[len("postgres://"):]
+    return database_url
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).strip().lower() not in ("0", "false", "no", "")
+
+
+def _pool_options() -> Dict[str, Any]:
+    """
+    Pool settings from env, shared by both engines (each has its own pool of this size).
+    Pre-ping stays on by default: hosted Postgres (Render etc.) drops idle connections,
+    and without it the first request after an idle period fails. Turn it off only
+    where DB_POOL_RECYCLE is below the server's idle cutoff.
+    """
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": _env_flag("DB_POOL_PRE_PING", "1"),
+    }
+
+
+def _session_settings() -> Dict[str, str]:
+    """Server-side timeouts set on every new connection; 0 (the default) leaves them off."""
+    out = {}
+    for name, env in (("statement_timeout", "DB_STATEMENT_TIMEOUT_MS"),
+                      ("idle_in_transaction_session_timeout", "DB_IDLE_IN_TX_TIMEOUT_MS")):
+        ms = int(os.getenv(env, "0"))
+        if ms > 0:
+            out[name] = str(ms)
+    return out
+
+
+def _get_engine() -> Engine:
+    global _engine
+    if _engine is not None:
+        return _engine
+
+    database_url = _database_url()
+    settings = _session_settings()
+    connect_args = {"options": " ".join(f"-c {k}={v}" for k, v in settings.items())} if settings else {}
 
     _engine = create_engine(
         database_url,
-        pool_pre_ping=True,
+        poolclass=TimedQueuePool,
+        connect_args=connect_args,
         future=True,
+        **_pool_options(),
     )
+    instrument(_engine)
     return _engine
 
 
 def init_db() -> None:
     """
-    Idempotent DB schema init.
-    IMPORTANT: no manual commit/rollback here; engine.begin() handles it.
+    Apply pending schema migrations (see app.migrations). Runs once per process;
+    later calls are a no-op.
     """
-    engine = _get_engine()
-
-    statements = [
-        # USERS
-        """
-        CREATE TABLE IF NOT EXISTS users(
-            id TEXT PRIMARY KEY,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TIMESTAMPTZ NOT NULL
-        );
-        """,
-        # PACKAGES
-        """
-        CREATE TABLE IF NOT EXISTS packages(
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            price_cents INTEGER NOT NULL,
-            currency TEXT NOT NULL,
-            stripe_price_id TEXT NOT NULL,
-            created_at TIMESTAMPTZ NOT NULL
-        );
-        """,
-        # SUBSCRIPTIONS
-        """
-        CREATE TABLE IF NOT EXISTS subscriptions(
-            id TEXT PRIMARY KEY,
-            user_id TEXT NOT NULL,
-            package_id TEXT NOT NULL,
-            status TEXT NOT NULL,
-            stripe_subscription_id TEXT,
-            created_at TIMESTAMPTZ NOT NULL
-        );
-        """,
-        # PLAYLISTS
-        """
-        CREATE TABLE IF NOT EXISTS playlists(
-            id TEXT PRIMARY KEY,
-            user_id TEXT NOT NULL,
-            url TEXT NOT NULL,
-            created_at TIMESTAMPTZ NOT NULL
-        );
-        """,
-        # EPG (ВАЖНО: description вместо desc)
-        """
-        CREATE TABLE IF NOT EXISTS epg_programmes(
-            playlist_id TEXT NOT NULL,
-            tvg_id TEXT NOT NULL,
-            start_utc TIMESTAMPTZ NOT NULL,
-            stop_utc TIMESTAMPTZ NOT NULL,
-            title TEXT,
-            description TEXT,
-            PRIMARY KEY (playlist_id, tvg_id, start_utc, stop_utc)
-        );
-        """,
-    ]
-
-    with engine.begin() as conn:
-        for stmt in statements:
-            conn.execute(text(stmt))
+    from app.migrations import run_migrations
+    run_migrations()
 
 
 @contextmanager
 def db():
     """
-    Safe connection context. Always ensures schema exists.
+    Pooled connection in a transaction. Schema is migrated at startup, not here.
     Uses engine.begin() to avoid 'transaction is inactive' issues.
+    Inside unit_of_work() this is the unit's connection; commit/rollback is the unit's.
     """
-    init_db()
+    unit = _unit.get()
+    if unit is not None:
+        yield unit[0]
+        return
     engine = _get_engine()
     with engine.begin() as conn:
         yield conn
+
+
+@contextmanager
+def unit_of_work():
+    """
+    One connection and one transaction for everything in the block: every db()
+    inside it (storage helpers included) joins it instead of checking out its own,
+    so a multi-step operation commits once, atomically. Nested units join the outer one.
+    Scoped by a contextvar, so it covers the current thread / task only; use it
+    around sync code (handlers run in the threadpool), not across awaits.
+    """
+    unit = _unit.get()
+    if unit is not None:
+        yield unit[0]
+        return
+    callbacks: List[Callable[[], None]] = []
+    with _get_engine().begin() as conn:
+        token = _unit.set((conn, callbacks))
+        try:
+            yield conn
+        finally:
+            _unit.reset(token)
+    for fn in callbacks:
+        fn()
+
+
+def on_commit(fn: Callable[[], None]) -> None:
+    """
+    Run fn after the current unit of work commits (dropped on rollback).
+    Outside a unit the caller's db() block has already committed, so fn runs now.
+    """
+    unit = _unit.get()
+    if unit is None:
+        fn()
+    else:
+        unit[1].append(fn)
+
+
+def without_timeouts(conn: Connection) -> None:
+    """
+    Lift DB_STATEMENT_TIMEOUT_MS / DB_IDLE_IN_TX_TIMEOUT_MS for the current transaction.
+    For migrations and bulk jobs (EPG staging waits on the download inside its transaction).
+    """
+    conn.execute(text("SET LOCAL statement_timeout = 0"))
+    conn.execute(text("SET LOCAL idle_in_transaction_session_timeout = 0"))
+
+
+def _get_async_engine() -> AsyncEngine:
+    """
+    asyncpg engine for async handlers, with its own pool next to the sync one.
+    Same DATABASE_URL; libpq's sslmode=... is passed to asyncpg as ssl=...
+    """
+    global _async_engine
+    if _async_engine is not None:
+        return _async_engine
+
+    url = make_url(_database_url()).set(drivername="postgresql+asyncpg")
+    connect_args = {}
+    sslmode = url.query.get("sslmode")
+    if sslmode:
+        url = url.difference_update_query(["sslmode"])
+        connect_args["ssl"] = sslmode
+    settings = _session_settings()
+    if settings:
+        connect_args["server_settings"] = settings
+
+    _async_engine = create_async_engine(
+        url,
+        poolclass=TimedAsyncQueuePool,
+        connect_args=connect_args,
+        **_pool_options(),
+    )
+    instrument(_async_engine.sync_engine)
+    return _async_engine
+
+
+@asynccontextmanager
+async def adb() -> AsyncIterator[AsyncConnection]:
+    """
+    Async counterpart of db(): pooled asyncpg connection in a transaction.
+    Awaiting queries releases the event loop instead of holding a threadpool thread.
+    """
+    engine = _get_async_engine()
+    async with engine.begin() as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def advisory_lock(key: str, wait: bool = False, poll: float = 1.0) -> AsyncIterator[bool]:
+    """
+    Session-level pg_try_advisory_lock(hashtext(key)) across workers; yields whether
+    it was granted (with `wait`, polls until it is). Held on a dedicated async
+    connection outside any transaction, so idle_in_transaction_session_timeout
+    doesn't apply; a dropped connection releases it.
+    """
+    engine = _get_async_engine()
+    async with engine.connect() as conn:
+        while True:
+            got = (await conn.execute(text("SELECT pg_try_advisory_lock(hashtext(:k))"), {"k": key})).scalar_one()
+            await conn.commit()
+            if got or not wait:
+                break
+            await asyncio.sleep(poll)
+        try:
+            yield got
+        finally:
+            if got:
+                await conn.execute(text("SELECT pg_advisory_unlock(hashtext(:k))"), {"k": key})
+                await conn.commit()
+
+
+async def dispose_async_engine() -> None:
+    global _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+
+
+def pool_stats() -> Dict[str, Any]:
+    """Pool gauges of the engines created so far, plus checkout/statement timings."""
+    pools = {}
+    if _engine is not None:
+        pools["sync"] = pool_status(_engine.pool)
+    if _async_engine is not None:
+        pools["async"] = pool_status(_async_engine.sync_engine.pool)
+    return {"config": _pool_options(), "server_settings": _session_settings(), "pools": pools, **db_stats.stats()}
+
+
+def _copy_value(v) -> str:
+    if v is None:
+        return "\\N"
+    s = v if isinstance(v, str) else str(v)
+    return s.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_rows(conn: Connection, table: str, columns: Sequence[str], rows: Iterable[Sequence]) -> int:
+    """
+    Bulk load rows into `table` inside the current transaction.
+    Uses COPY ... FROM STDIN on psycopg2, multi-row executemany otherwise.
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+
+    cols = ", ".join(columns)
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        if hasattr(cursor, "copy_expert"):
+            buf = io.StringIO()
+            for row in rows:
+                buf.write("\t".join(_copy_value(v) for v in row))
+                buf.write("\n")
+            buf.seek(0)
+            cursor.copy_expert(f"COPY {table} ({cols}) FROM STDIN", buf)
+            return len(rows)
+    finally:
+        cursor.close()
+
+    placeholders = ", ".join(f":{c}" for c in columns)
+    conn.execute(
+        text(f"INSERT INTO {table} ({cols}) VALUES ({placeholders})"),
+        [dict(zip(columns, row)) for row in rows],
+    )
+    return len(rows)
@@ -0,0 +1,180 @@
+"""
+Pool and statement instrumentation for the sync and async engines.
+
+Checkout wait is measured by TimedQueuePool / TimedAsyncQueuePool (time to get
+a connection from the pool, including opening a new one; pre-ping excluded),
+statement latency by before/after_cursor_execute listeners. Both feed
+`db_stats` (counters plus a latency histogram, served by /api/admin/stats/db)
+and any hook registered with add_hook(fn), called as fn(kind, seconds) with
+kind "checkout" or "statement", e.g. to forward them to statsd/Prometheus.
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+log = logging.getLogger("db")
+
+Hook = Callable[[str, float], None]
+
+# histogram upper bounds, ms; the last bucket is everything above
+_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_hooks: List[Hook] = []
+
+
+def add_hook(fn: Hook) -> None:
+    _hooks.append(fn)
+
+
+def _slow_ms() -> float:
+    return float(os.getenv("DB_SLOW_STATEMENT_MS", "500"))
+
+
+class _Timings:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(_BUCKETS_MS) + 1)
+
+    def add(self, ms: float) -> None:
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.buckets[bisect.bisect_left(_BUCKETS_MS, ms)] += 1
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the q-quantile (None above the last bound)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return _BUCKETS_MS[i] if i < len(_BUCKETS_MS) else None
+        return None
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 3) if self.count else None,
+            "max_ms": round(self.max, 3),
+            "p50_le_ms": self.quantile(0.5),
+            "p95_le_ms": self.quantile(0.95),
+            "p99_le_ms": self.quantile(0.99),
+            "histogram_ms": {str(b): n for b, n in zip(_BUCKETS_MS + ("inf",), self.buckets)},
+        }
+
+
+class DbStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._checkout = _Timings()
+        self._statements = _Timings()
+        self.checkout_timeouts = 0
+        self.statement_errors = 0
+        self.slow_statements = 0
+
+    def checkout(self, seconds: float) -> None:
+        with self._lock:
+            self._checkout.add(seconds * 1000.0)
+        for fn in _hooks:
+            fn("checkout", seconds)
+
+    def checkout_timeout(self) -> None:
+        with self._lock:
+            self.checkout_timeouts += 1
+
+    def statement(self, seconds: float, statement: str) -> None:
+        ms = seconds * 1000.0
+        slow = ms >= _slow_ms()
+        with self._lock:
+            self._statements.add(ms)
+            if slow:
+                self.slow_statements += 1
+        if slow:
+            log.warning("slow statement %.0f ms: %s", ms, " ".join(statement.split())[:300])
+        for fn in _hooks:
+            fn("statement", seconds)
+
+    def statement_error(self) -> None:
+        with self._lock:
+            self.statement_errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "checkout_wait": self._checkout.summary(),
+                "checkout_timeouts": self.checkout_timeouts,
+                "statements": self._statements.summary(),
+                "statement_errors": self.statement_errors,
+                "slow_statements": self.slow_statements,
+                "slow_threshold_ms": _slow_ms(),
+            }
+
+
+db_stats = DbStats()
+
+
+class _TimedGet:
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            db_stats.checkout_timeout()
+            raise
+        db_stats.checkout(time.perf_counter() - t0)
+        return conn
+
+
+class TimedQueuePool(_TimedGet, QueuePool):
+    """QueuePool that reports how long each checkout waited for a connection."""
+
+
+class TimedAsyncQueuePool(_TimedGet, AsyncAdaptedQueuePool):
+    """Same for the asyncpg engine."""
+
+
+def pool_status(pool) -> Dict[str, Any]:
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+    }
+
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("_stmt_t0", []).append(time.perf_counter())
+
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("_stmt_t0")
+    if starts:
+        db_stats.statement(time.perf_counter() - starts.pop(), statement)
+
+
+def _error(ctx):
+    starts = ctx.connection.info.get("_stmt_t0") if ctx.connection is not None else None
+    if starts:
+        starts.pop()
+    db_stats.statement_error()
+
+
+def instrument(engine: Engine) -> None:
+    """Attach the statement timers to an engine (for an AsyncEngine pass .sync_engine)."""
+    event.listen(engine, "before_cursor_execute", _before)
+    event.listen(engine, "after_cursor_execute", _after)
+    event.listen(engine, "handle_error", _error)
@@ -5,7 +5,9 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy import text
 
 from app.security import verify_token
-from app.db import db
+from app.db import adb
+from app.cache import entitlement_cache
+from app.services.storage import get_active_playlists_for_user_async
 
 bearer = HTTPBearer(auto_error=False)
 
@@ -14,7 +16,26 @@ def require_admin(x_admin_key: str = Header(default="", alias="X-Admin-Key")):
         raise HTTPException(status_code=401, detail="Admin key missing or invalid")
     return True
 
-def require_user(creds: HTTPAuthorizationCredentials = Depends(bearer)):
+async def _load_entitlement(user_id: str):
+    async with adb() as conn:
+        u = (await conn.execute(
+            text("SELECT id, is_disabled, status, paid_until FROM users WHERE id=:id"),
+            {"id": user_id},
+        )).mappings().first()
+    if not u:
+        return None
+    pls = await get_active_playlists_for_user_async(user_id)
+    return {
+        "is_disabled": bool(u["is_disabled"]),
+        "status": u["status"],
+        "paid_until": u["paid_until"],
+        "playlist_ids": [p["id"] for p in pls],
+        "playlist_versions": {p["id"]: p["version"] for p in pls},
+        # id:version pairs, used as the catalog revision in ETags
+        "catalog_rev": ",".join(f"{p['id']}:{p['version']}" for p in sorted(pls, key=lambda p: p["id"])),
+    }
+
+async def require_user(creds: HTTPAuthorizationCredentials = Depends(bearer)):
     if creds is None or creds.scheme.lower() != "bearer":
         raise HTTPException(status_code=401, detail="Missing Bearer token")
 
@@ -26,21 +47,25 @@ def require_user(creds: HTTPAuthorizationCredentials = Depends(bearer)):
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid token payload")
 
-    with db() as conn:
-        u = conn.execute(
-            text("SELECT id, is_disabled, status, paid_until FROM users WHERE id=:id"),
-            {"id": user_id},
-        ).mappings().first()
-
-        if not u:
+    ent = entitlement_cache.get(user_id)
+    if ent is None:
+        ent = await _load_entitlement(user_id)
+        if ent is None:
             raise HTTPException(status_code=401, detail="User not found")
-        if bool(u["is_disabled"]):
-            raise HTTPException(status_code=403, detail="User is disabled")
+        entitlement_cache.set(user_id, ent)
+
+    if ent["is_disabled"]:
+        raise HTTPException(status_code=403, detail="User is disabled")
 
-        status = (u["status"] or "").lower()
-        pu = u["paid_until"]
-        if status != "active" or pu is None or datetime.now(timezone.utc) >= pu:
-            # 402 is reasonable for "payment required"
-            raise HTTPException(status_code=402, detail="Subscription inactive or expired. Please оплатите пакет.")
+    status = (ent["status"] or "").lower()
+    pu = ent["paid_until"]
+    if status != "active" or pu is None or datetime.now(timezone.utc) >= pu:
+        # 402 is reasonable for "payment required"
+        raise HTTPException(status_code=402, detail="Subscription inactive or expired. Please оплатите пакет.")
 
-    return {"user_id": user_id}
+    return {
+        "user_id": user_id,
+        "playlist_ids": ent["playlist_ids"],
+        "playlist_versions": ent["playlist_versions"],
+        "catalog_rev": ent["catalog_rev"],
+    }
@@ -0,0 +1,27 @@
+import hashlib
+
+from fastapi import Request, Response
+
+
+def make_etag(*parts) -> str:
+    """Strong ETag from the values that fully determine a response body."""
+    raw = "\x1f".join("" if p is None else str(p) for p in parts)
+    return '"' + hashlib.sha1(raw.encode("utf-8")).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    if inm.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison
+    return etag in (t.strip().removeprefix("W/") for t in inm.split(","))
+
+
+def etag_headers(etag: str, private: bool = True) -> dict:
+    return {"ETag": etag, "Cache-Control": ("private" if private else "public") + ", no-cache"}
+
+
+def not_modified(etag: str, private: bool = True) -> Response:
+    return Response(status_code=304, headers=etag_headers(etag, private))
@@ -6,6 +6,8 @@ from dotenv import load_dotenv
 from app.routes import api_router
 from app.services.scheduler import start_scheduler
 from app.services.bootstrap import bootstrap
+from app.services.epg_service import shutdown_epg_workers
+from app.db import dispose_async_engine
 
 load_dotenv()
 
@@ -25,10 +27,15 @@ def create_app() -> FastAPI:
 
     @app.on_event("startup")
     async def _startup():
-        # Создаём таблицы + сидим пакеты (если заданы переменные Stripe)
+        # Миграции схемы + сидим пакеты (если заданы переменные Stripe)
         bootstrap()
         asyncio.create_task(start_scheduler())
 
+    @app.on_event("shutdown")
+    async def _shutdown():
+        shutdown_epg_workers()
+        await dispose_async_engine()
+
     return app
 
 
@@ -0,0 +1,326 @@
+"""
+Versioned schema migrations.
+
+Each migration is (version, name, steps); a step is a SQL string or a callable
+taking the connection. Pending migrations run once, in order, at startup
+(bootstrap), under a Postgres advisory lock so parallel workers don't race.
+Never edit an applied migration — append a new one.
+"""
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from app.db import _get_engine, without_timeouts
+from app.services.epg_retention import partition_by_source
+from app.services.epg_sources import backfill_playlist_sources, carry_fetch_state
+from app.services.search import normalize_search
+
+Step = Union[str, Callable[[Connection], None]]
+
+# arbitrary constant, identifies "schema migrations" in pg_locks
+_LOCK_KEY = 740_300_001
+
+_migrated = False
+
+
+def _backfill_channel_search(conn: Connection) -> None:
+    rows = conn.execute(text("SELECT playlist_id, tvg_id, name, tvg_name FROM channels WHERE search_text IS NULL")).mappings().all()
+    params = [
+        {"pid": r["playlist_id"], "tvg": r["tvg_id"], "st": normalize_search(r["name"], r["tvg_name"], r["tvg_id"])}
+        for r in rows
+    ]
+    if params:
+        conn.execute(text("UPDATE channels SET search_text=:st WHERE playlist_id=:pid AND tvg_id=:tvg"), params)
+
+
+def _recompute_channel_search(conn: Connection) -> None:
+    # normalize_search changed: rewrite only the rows whose key differs
+    rows = conn.execute(text("SELECT playlist_id, tvg_id, name, tvg_name, search_text FROM channels")).mappings().all()
+    params = []
+    for r in rows:
+        st = normalize_search(r["name"], r["tvg_name"], r["tvg_id"])
+        if st != r["search_text"]:
+            params.append({"pid": r["playlist_id"], "tvg": r["tvg_id"], "st": st})
+    if params:
+        conn.execute(text("UPDATE channels SET search_text=:st WHERE playlist_id=:pid AND tvg_id=:tvg"), params)
+
+
+MIGRATIONS: List[Tuple[int, str, List[Step]]] = [
+    (1, "baseline", [
+        """
+        CREATE TABLE IF NOT EXISTS users(
+            id TEXT PRIMARY KEY,
+            email TEXT UNIQUE,
+            password_hash TEXT,
+            created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS packages(
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            price_cents INTEGER NOT NULL,
+            currency TEXT NOT NULL,
+            stripe_price_id TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions(
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            package_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            stripe_subscription_id TEXT,
+            created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS playlists(
+            id TEXT PRIMARY KEY,
+            created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS epg_programmes(
+            playlist_id TEXT NOT NULL,
+            tvg_id TEXT NOT NULL,
+            start_utc TIMESTAMPTZ NOT NULL,
+            stop_utc TIMESTAMPTZ NOT NULL,
+            title TEXT,
+            description TEXT,
+            PRIMARY KEY (playlist_id, tvg_id, start_utc, stop_utc)
+        );
+        """,
+    ]),
+    (2, "columns and tables used by the code", [
+        # users: legacy code users have no email/password; billing + subscription state
+        "ALTER TABLE users ALTER COLUMN email DROP NOT NULL",
+        "ALTER TABLE users ALTER COLUMN password_hash DROP NOT NULL",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS code TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS note TEXT NOT NULL DEFAULT ''",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS device_limit INTEGER NOT NULL DEFAULT 2",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_disabled BOOLEAN NOT NULL DEFAULT FALSE",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'pending_payment'",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS paid_until TIMESTAMPTZ",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS stripe_customer_id TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS stripe_subscription_id TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS current_package_id TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS next_package_id TEXT",
+        # playlists belong to packages now (user_id/url are legacy)
+        """
+        DO $$ BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='playlists' AND column_name='user_id') THEN
+                ALTER TABLE playlists ALTER COLUMN user_id DROP NOT NULL;
+            END IF;
+            IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='playlists' AND column_name='url') THEN
+                ALTER TABLE playlists ALTER COLUMN url DROP NOT NULL;
+            END IF;
+        END $$;
+        """,
+        "ALTER TABLE playlists ADD COLUMN IF NOT EXISTS package_id TEXT",
+        "ALTER TABLE playlists ADD COLUMN IF NOT EXISTS source_type TEXT",
+        "ALTER TABLE playlists ADD COLUMN IF NOT EXISTS source_value TEXT",
+        "ALTER TABLE playlists ADD COLUMN IF NOT EXISTS m3u_text TEXT",
+        "ALTER TABLE playlists ADD COLUMN IF NOT EXISTS epg_url TEXT",
+        """
+        CREATE TABLE IF NOT EXISTS channels(
+            playlist_id TEXT NOT NULL,
+            tvg_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            tvg_name TEXT,
+            logo TEXT,
+            grp TEXT,
+            stream_url TEXT NOT NULL,
+            raw_extinf TEXT,
+            PRIMARY KEY (playlist_id, tvg_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_packages(
+            user_id TEXT NOT NULL,
+            package_id TEXT NOT NULL,
+            active_until TIMESTAMPTZ,
+            PRIMARY KEY (user_id, package_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_devices(
+            user_id TEXT NOT NULL,
+            device_id TEXT NOT NULL,
+            first_seen_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (user_id, device_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS login_codes(
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            code TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            used BOOLEAN NOT NULL DEFAULT FALSE
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payments(
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            provider TEXT NOT NULL,
+            event_type TEXT,
+            stripe_event_id TEXT,
+            stripe_customer_id TEXT,
+            stripe_subscription_id TEXT,
+            amount_cents INTEGER,
+            currency TEXT,
+            status TEXT,
+            raw_json TEXT,
+            created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+    ]),
+    (3, "epg staging and fetch state", [
+        # bulk COPY target, swapped into epg_programmes in one short transaction
+        """
+        CREATE UNLOGGED TABLE IF NOT EXISTS epg_programmes_staging(
+            stage_id TEXT NOT NULL,
+            tvg_id TEXT NOT NULL,
+            start_utc TIMESTAMPTZ NOT NULL,
+            stop_utc TIMESTAMPTZ NOT NULL,
+            title TEXT,
+            description TEXT
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS epg_programmes_staging_stage_idx ON epg_programmes_staging(stage_id)",
+        """
+        CREATE TABLE IF NOT EXISTS epg_fetch_state(
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            content_sha256 TEXT,
+            changed_at TIMESTAMPTZ
+        );
+        """,
+    ]),
+    (4, "lookup indexes", [
+        "CREATE INDEX IF NOT EXISTS users_code_idx ON users(code)",
+        "CREATE INDEX IF NOT EXISTS users_stripe_customer_idx ON users(stripe_customer_id)",
+        "CREATE INDEX IF NOT EXISTS users_stripe_subscription_idx ON users(stripe_subscription_id)",
+        "CREATE INDEX IF NOT EXISTS playlists_package_created_idx ON playlists(package_id, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS login_codes_user_created_idx ON login_codes(user_id, created_at DESC)",
+    ]),
+    (5, "current playlist per package", [
+        """
+        CREATE TABLE IF NOT EXISTS package_current_playlist(
+            package_id TEXT PRIMARY KEY,
+            playlist_id TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        """
+        INSERT INTO package_current_playlist(package_id, playlist_id, updated_at)
+        SELECT DISTINCT ON (package_id) package_id, id, created_at
+        FROM playlists WHERE package_id IS NOT NULL
+        ORDER BY package_id, created_at DESC
+        ON CONFLICT (package_id) DO NOTHING;
+        """,
+    ]),
+    (6, "channel search column and trigram index", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "ALTER TABLE channels ADD COLUMN IF NOT EXISTS search_text TEXT",
+        _backfill_channel_search,
+        "CREATE INDEX IF NOT EXISTS channels_search_trgm_idx ON channels USING gin (search_text gin_trgm_ops)",
+    ]),
+    (7, "channel keyset page index", [
+        "CREATE INDEX IF NOT EXISTS channels_page_idx ON channels(playlist_id, (COALESCE(grp, '')), name, tvg_id)",
+    ]),
+    (8, "playlist version for catalog etags", [
+        "ALTER TABLE playlists ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+    ]),
+    (9, "btree_gist for the epg overlap index", [
+        "CREATE EXTENSION IF NOT EXISTS btree_gist",
+        # tstzrange() rejects stop < start; such programmes are junk anyway
+        "DELETE FROM epg_programmes WHERE stop_utc < start_utc",
+    ]),
+    (10, "shared epg sources", [
+        """
+        CREATE TABLE IF NOT EXISTS epg_sources(
+            id TEXT PRIMARY KEY,
+            url TEXT NOT NULL UNIQUE,
+            etag TEXT,
+            last_modified TEXT,
+            content_sha256 TEXT,
+            changed_at TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        "ALTER TABLE playlists ADD COLUMN IF NOT EXISTS epg_source_id TEXT",
+        "CREATE INDEX IF NOT EXISTS playlists_epg_source_idx ON playlists(epg_source_id)",
+        backfill_playlist_sources,
+        carry_fetch_state,
+        "DROP TABLE IF EXISTS epg_fetch_state",
+    ]),
+    (11, "epg keyed by shared source, in daily partitions", [
+        # converted in place: stored guides survive the deploy
+        partition_by_source,
+    ]),
+    (12, "per-programme content hash for diff ingest", [
+        "ALTER TABLE epg_programmes_staging ADD COLUMN IF NOT EXISTS content_hash TEXT",
+        "ALTER TABLE epg_programmes ADD COLUMN IF NOT EXISTS content_hash TEXT",
+    ]),
+    (13, "playlist content hash for upload dedup", [
+        "ALTER TABLE playlists ADD COLUMN IF NOT EXISTS content_hash TEXT",
+        # same value as storage.playlist_hash()
+        "UPDATE playlists SET content_hash = encode(sha256(convert_to(m3u_text, 'UTF8')), 'hex') "
+        "WHERE m3u_text IS NOT NULL AND content_hash IS NULL",
+    ]),
+    (14, "search keys keep non-Latin letters, casefolded", [
+        _recompute_channel_search,
+    ]),
+    (15, "channel filter fingerprint per epg source", [
+        "ALTER TABLE epg_sources ADD COLUMN IF NOT EXISTS filter_hash TEXT",
+    ]),
+]
+
+
+def _apply(conn: Connection, steps: List[Step]) -> None:
+    for step in steps:
+        if callable(step):
+            step(conn)
+        else:
+            conn.execute(text(step))
+
+
+def run_migrations() -> int:
+    """
+    Apply pending migrations once per process. Returns the schema version.
+    IMPORTANT: no manual commit/rollback here; engine.begin() handles it.
+    """
+    global _migrated
+    versions = [v for v, _, _ in MIGRATIONS]
+    assert versions == sorted(set(versions)), "migration versions must be unique and ascending"
+    if _migrated:
+        return versions[-1]
+
+    with _get_engine().begin() as conn:
+        without_timeouts(conn)
+        conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": _LOCK_KEY})
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version("
+            "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMPTZ NOT NULL)"
+        ))
+        current = conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar_one()
+        for version, name, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            _apply(conn, steps)
+            conn.execute(
+                text("INSERT INTO schema_version(version, name, applied_at) VALUES(:v,:n,:t)"),
+                {"v": version, "n": name, "t": datetime.now(timezone.utc)},
+            )
+            current = version
+
+    _migrated = True
+    return current
@@ -1,10 +1,15 @@
+import codecs
 import re
 from dataclasses import dataclass
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Iterable, Iterator, Union
 
-_attr_re = re.compile(r'(\w+(?:-\w+)*)="([^"]*)"')
+# key="value"; a key never starts right after a word char, and the atomic group
+# keeps the regex from retrying every position inside words of the display name
+_attr_re = re.compile(r'(?<!\w)((?>\w+(?:-\w+)*))="([^"]*)"')
+# whole-text input is fed in slices so only one slice of lines is alive at a time
+_SLICE = 256 * 1024
 
-@dataclass
+@dataclass(slots=True)
 class Channel:
     tvg_id: str
     name: str
@@ -14,74 +19,122 @@ class Channel:
     stream_url: str
     raw_extinf: str
 
+def epg_url_from_header(header: Dict[str, str]) -> Optional[str]:
+    return header.get("url-tvg") or header.get("x-tvg-url")
+
 def extract_epg_url(m3u_text: str) -> Optional[str]:
     for line in m3u_text.splitlines():
         line = line.strip()
         if not line:
             continue
         if line.startswith("#EXTM3U"):
-            attrs = dict(_attr_re.findall(line))
-            return attrs.get("url-tvg") or attrs.get("x-tvg-url")
+            return epg_url_from_header(dict(_attr_re.findall(line)))
         break
     return None
 
-def _parse_extinf_attrs(extinf_line: str) -> Tuple[Dict[str, str], str]:
-    attrs = dict(_attr_re.findall(extinf_line))
-    display_name = ""
-    if "," in extinf_line:
-        display_name = extinf_line.split(",", 1)[1].strip()
-    return attrs, display_name
+def _clean(s: Optional[str]) -> Optional[str]:
+    if s is None:
+        return None
+    s = s.strip()
+    return s if s else None
 
-def parse_m3u(m3u_text: str) -> List[Channel]:
-    lines = [ln.rstrip("\r") for ln in m3u_text.splitlines()]
-    channels: List[Channel] = []
-    pending_extinf = None
-    pending_attrs = None
-    pending_name = None
-    pending_grp = None
-
-    def clean(s):
-        if s is None: return None
-        s = s.strip()
-        return s if s else None
-
-    for raw in lines:
-        line = raw.strip()
-        if not line:
-            continue
 
-        if line.startswith("#EXTINF"):
-            pending_extinf = line
-            attrs, disp = _parse_extinf_attrs(line)
-            pending_attrs = attrs
-            pending_name = disp or attrs.get("tvg-name") or attrs.get("tvg-id") or "Channel"
-            if "group-title" in attrs:
-                pending_grp = attrs.get("group-title")
-            continue
+class M3UParser:
+    """
+    Incremental M3U parser: feed() text or bytes in any chunking, get Channel
+    records back as soon as their URL line is complete. Attributes of the
+    leading #EXTM3U line end up in `header` (url-tvg etc.) from the same pass.
+    """
 
-        if line.startswith("#EXTGRP:"):
-            pending_grp = line.split(":", 1)[1].strip() or pending_grp
-            continue
+    def __init__(self, encoding: str = "utf-8", header: Optional[Dict[str, str]] = None) -> None:
+        self.header: Dict[str, str] = header if header is not None else {}
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self._tail = ""
+        self._first = True
+        self._extinf: Optional[str] = None
+        self._attrs: Optional[Dict[str, str]] = None
+        self._name: Optional[str] = None
+        self._grp: Optional[str] = None
 
-        if line.startswith("#"):
-            continue
+    def feed(self, data: Union[str, bytes]) -> List[Channel]:
+        if isinstance(data, bytes):
+            data = self._decoder.decode(data)
+        if not data:
+            return []
+        lines = (self._tail + data).splitlines(keepends=True)
+        # keep an unterminated last line for the next chunk
+        self._tail = lines.pop() if lines[-1].splitlines() == [lines[-1]] else ""
+        return self._lines(lines)
+
+    def close(self) -> List[Channel]:
+        rest = self._tail + self._decoder.decode(b"", final=True)
+        self._tail = ""
+        return self._lines(rest.splitlines())
 
-        if pending_extinf and pending_attrs:
-            tvg_id = pending_attrs.get("tvg-id") or pending_attrs.get("tvgid") or pending_attrs.get("tvg_id")
-            tvg_id = (tvg_id or (pending_attrs.get("tvg-name") or pending_name or "unknown")).strip()
-            channels.append(Channel(
-                tvg_id=tvg_id,
-                name=(pending_name or tvg_id).strip(),
-                tvg_name=clean(pending_attrs.get("tvg-name")),
-                logo=clean(pending_attrs.get("tvg-logo")),
-                grp=clean(pending_grp),
-                stream_url=line,
-                raw_extinf=pending_extinf
-            ))
-
-        pending_extinf = None
-        pending_attrs = None
-        pending_name = None
-        pending_grp = None
-
-    return channels
+    @property
+    def epg_url(self) -> Optional[str]:
+        return epg_url_from_header(self.header)
+
+    def _lines(self, lines: List[str]) -> List[Channel]:
+        out: List[Channel] = []
+        append = out.append
+        for raw in lines:
+            line = raw.strip()
+            if not line:
+                continue
+            if self._first:
+                self._first = False
+                if line.startswith("#EXTM3U"):
+                    self.header.update(_attr_re.findall(line))
+                    continue
+
+            if line[0] == "#":
+                if line.startswith("#EXTINF"):
+                    self._extinf = line
+                    attrs = dict(_attr_re.findall(line))
+                    self._attrs = attrs
+                    disp = line.partition(",")[2].strip()
+                    self._name = disp or attrs.get("tvg-name") or attrs.get("tvg-id") or "Channel"
+                    if "group-title" in attrs:
+                        self._grp = attrs["group-title"]
+                elif line.startswith("#EXTGRP:"):
+                    self._grp = line.split(":", 1)[1].strip() or self._grp
+                continue
+
+            attrs = self._attrs
+            if self._extinf and attrs:
+                tvg_id = attrs.get("tvg-id") or attrs.get("tvgid") or attrs.get("tvg_id")
+                tvg_id = (tvg_id or (attrs.get("tvg-name") or self._name or "unknown")).strip()
+                append(Channel(
+                    tvg_id,
+                    (self._name or tvg_id).strip(),
+                    _clean(attrs.get("tvg-name")),
+                    _clean(attrs.get("tvg-logo")),
+                    _clean(self._grp),
+                    line,
+                    self._extinf,
+                ))
+            self._extinf = None
+            self._attrs = None
+            self._name = None
+            self._grp = None
+        return out
+
+
+def iter_m3u(source: Union[str, bytes, Iterable[Union[str, bytes]]], header: Optional[Dict[str, str]] = None,
+             encoding: str = "utf-8") -> Iterator[Channel]:
+    """
+    Stream channels from a whole text/bytes or an iterable of chunks.
+    If `header` is given it is filled with the #EXTM3U attributes.
+    """
+    parser = M3UParser(encoding=encoding, header=header)
+    if isinstance(source, (str, bytes)):
+        chunks = (source[i:i + _SLICE] for i in range(0, len(source), _SLICE))
+    else:
+        chunks = source
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+def parse_m3u(m3u_text: str) -> List[Channel]:
+    return list(iter_m3u(m3u_text))
@@ -1,32 +1,87 @@
-import gzip, io
+import gzip, io, zlib
 from dataclasses import dataclass
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Iterator
+from typing import Dict, Optional, Iterator, Iterable, List
 from lxml import etree
 
+_GZIP_MAGIC = b"\x1f\x8b"
+# max decompressed bytes produced per inflate step (bounds the gunzip buffer)
+_INFLATE_STEP = 1024 * 1024
+
 @dataclass
 class Programme:
     tvg_id: str
-    start_utc: str
-    stop_utc: str
+    start_utc: datetime
+    stop_utc: datetime
     title: Optional[str]
     desc: Optional[str]
 
-def _xmltv_to_utc_iso(dt_str: str) -> str:
-    s = dt_str.strip()
+_DIGITS = frozenset("0123456789")
+# "+0300" -> timedelta; a guide uses a handful of offsets
+_offsets: Dict[str, timedelta] = {}
+# "YYYYMMDDHH" -> aware UTC datetime of that hour; programmes cluster on a few days
+_hours: Dict[str, datetime] = {}
+_HOURS_MAX = 4096
+# whole recently seen values: many channels share the same start/stop times
+_recent: Dict[str, datetime] = {}
+_RECENT_MAX = 65536
+
+def _parse_slow(s: str) -> datetime:
+    # previous strptime-based conversion; raises ValueError on malformed input
     if " " in s:
         main, tz = s.split(" ", 1)
         s = main + tz
     main = s[:14]
     tz = s[14:19] if len(s) >= 19 and s[14] in "+-" else None
-    dt_naive = datetime.strptime(main, "%Y%m%d%H%M%S")
+    dt_utc = datetime.strptime(main, "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
     if tz:
         sign = 1 if tz[0] == "+" else -1
-        offset_minutes = sign * (int(tz[1:3]) * 60 + int(tz[3:5]))
-        dt_utc = dt_naive.replace(tzinfo=timezone.utc) - timedelta(minutes=offset_minutes)
+        dt_utc -= timedelta(minutes=sign * (int(tz[1:3]) * 60 + int(tz[3:5])))
+    return dt_utc
+
+def _offset(tz: str) -> timedelta:
+    off = _offsets.get(tz)
+    if off is None:
+        minutes = int(tz[1:3]) * 60 + int(tz[3:5])
+        off = _offsets[tz] = timedelta(minutes=-minutes if tz[0] == "+" else minutes)
+    return off
+
+def parse_xmltv_time(value: str) -> datetime:
+    """
+    XMLTV "YYYYMMDDhhmmss +zzzz" -> aware UTC datetime. Fixed-width slicing with
+    memoized values, hours and offsets; anything unusual goes through strptime.
+    """
+    dt = _recent.get(value)
+    if dt is None:
+        dt = _convert(value.strip())
+        if len(_recent) >= _RECENT_MAX:
+            _recent.clear()
+        _recent[value] = dt
+    return dt
+
+def _convert(s: str) -> datetime:
+    if len(s) < 14 or not _DIGITS.issuperset(s[:14]):
+        return _parse_slow(s)
+    rest = s[14:]
+    if rest:
+        if rest[0] == " ":
+            rest = rest[1:]
+        if len(rest) >= 5 and rest[0] in "+-" and _DIGITS.issuperset(rest[1:5]):
+            off = _offset(rest[:5])
+        elif rest[0] in "+-":
+            return _parse_slow(s)
+        else:
+            off = None
     else:
-        dt_utc = dt_naive.replace(tzinfo=timezone.utc)
-    return dt_utc.isoformat().replace("+00:00", "Z")
+        off = None
+    base = _hours.get(s[:10])
+    if base is None:
+        if len(_hours) >= _HOURS_MAX:
+            _hours.clear()
+        base = _hours[s[:10]] = datetime(int(s[:4]), int(s[4:6]), int(s[6:8]), int(s[8:10]), tzinfo=timezone.utc)
+    mm, ss = s[10:12], s[12:14]
+    dt = base if mm == "00" and ss == "00" else base.replace(minute=int(mm), second=int(ss))
+    return dt + off if off else dt
 
 def load_xmltv_from_path(path: str) -> bytes:
     with open(path, "rb") as f:
@@ -35,20 +90,105 @@ def load_xmltv_from_path(path: str) -> bytes:
         return gzip.decompress(data)
     return data
 
+def _programme_from_elem(elem) -> Optional[Programme]:
+    tvg_id = elem.get("channel") or ""
+    start = elem.get("start") or ""
+    stop = elem.get("stop") or ""
+    title_el = elem.find("title")
+    desc_el = elem.find("desc")
+    title = title_el.text.strip() if (title_el is not None and title_el.text) else None
+    desc = desc_el.text.strip() if (desc_el is not None and desc_el.text) else None
+    if tvg_id and start and stop:
+        return Programme(tvg_id=tvg_id, start_utc=parse_xmltv_time(start), stop_utc=parse_xmltv_time(stop), title=title, desc=desc)
+    return None
+
+def _release(elem) -> None:
+    # keep the tree empty: drop the element and everything parsed before it
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+class XmltvStreamParser:
+    """
+    Incremental XMLTV parser. Feed raw chunks (plain or gzip, detected by magic),
+    get back the programmes completed so far. Memory is bounded by the chunk size
+    plus one <programme> element, regardless of the guide size.
+    """
+
+    def __init__(self) -> None:
+        self._parser = etree.XMLPullParser(events=("end",), tag="programme", recover=True, huge_tree=True)
+        self._head = b""
+        self._sniffed = False
+        self._inflate = None
+
+    def feed(self, chunk: bytes) -> List[Programme]:
+        if not self._sniffed:
+            self._head += chunk
+            if len(self._head) < 2:
+                return []
+            chunk, self._head = self._head, b""
+            self._sniffed = True
+            if chunk[:2] == _GZIP_MAGIC:
+                self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        if self._inflate is None:
+            self._parser.feed(chunk)
+            return self._drain()
+
+        out: List[Programme] = []
+        data = chunk
+        while data:
+            xml = self._inflate.decompress(data, _INFLATE_STEP)
+            if xml:
+                self._parser.feed(xml)
+                out.extend(self._drain())
+            if self._inflate.unconsumed_tail:
+                data = self._inflate.unconsumed_tail
+            elif self._inflate.eof and self._inflate.unused_data:
+                # concatenated gzip members
+                data = self._inflate.unused_data
+                self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = b""
+        return out
+
+    def close(self) -> List[Programme]:
+        out: List[Programme] = []
+        if not self._sniffed and self._head:
+            self._sniffed = True
+            self._parser.feed(self._head)
+            self._head = b""
+        if self._inflate is not None:
+            tail = self._inflate.flush()
+            if tail:
+                self._parser.feed(tail)
+        self._parser.close()
+        out.extend(self._drain())
+        return out
+
+    def _drain(self) -> List[Programme]:
+        out: List[Programme] = []
+        for _event, elem in self._parser.read_events():
+            try:
+                p = _programme_from_elem(elem)
+                if p is not None:
+                    out.append(p)
+            finally:
+                _release(elem)
+        return out
+
+def iter_programmes_from_chunks(chunks: Iterable[bytes]) -> Iterator[Programme]:
+    parser = XmltvStreamParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
 def iter_programmes_from_bytes(xml_bytes: bytes) -> Iterator[Programme]:
     context = etree.iterparse(io.BytesIO(xml_bytes), events=("end",), tag="programme", recover=True, huge_tree=True)
     for _event, elem in context:
         try:
-            tvg_id = elem.get("channel") or ""
-            start = elem.get("start") or ""
-            stop = elem.get("stop") or ""
-            title_el = elem.find("title")
-            desc_el = elem.find("desc")
-            title = title_el.text.strip() if (title_el is not None and title_el.text) else None
-            desc = desc_el.text.strip() if (desc_el is not None and desc_el.text) else None
-            if tvg_id and start and stop:
-                yield Programme(tvg_id=tvg_id, start_utc=_xmltv_to_utc_iso(start), stop_utc=_xmltv_to_utc_iso(stop), title=title, desc=desc)
+            p = _programme_from_elem(elem)
+            if p is not None:
+                yield p
         finally:
-            elem.clear()
-            while elem.getprevious() is not None:
-                del elem.getparent()[0]
+            _release(elem)
@@ -4,11 +4,13 @@ from datetime import datetime, timezone
 from sqlalchemy import text
 
 from app.db import db
+from app.migrations import run_migrations
 
 
 def bootstrap():
-    # Таблицы создаются в init_db() внутри db()
-    # Тут только сидинг тарифов
+    # Миграции схемы — один раз при старте (db() больше не делает DDL)
+    run_migrations()
+    # Сидинг тарифов
     ensure_default_packages()
 
 
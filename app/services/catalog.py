@@ -0,0 +1,192 @@
+"""
+Precompressed per-playlist catalog snapshots.
+
+Playlists are identical for every subscriber of a package, so the full channel
+catalog (+ group list) is serialized once at ingest time and stored as raw,
+gzip and brotli bytes. /api/me/catalog then only picks the right encoding and
+copies bytes. Snapshots live in memory (small LRU) and on disk (CATALOG_DIR);
+a missing one is rebuilt from the channels table on first use.
+"""
+import gzip
+import json
+import os
+import re
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import text
+
+from app.cache import TTLCache
+from app.db import db
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+_ITEM_FIELDS = ("playlist_id", "tvg_id", "name", "tvg_name", "logo", "grp", "stream_url")
+
+_snapshots = TTLCache(maxsize=int(os.getenv("CATALOG_CACHE_SIZE", "16")), ttl=24 * 3600)
+# playlist_id -> lock, so concurrent misses on one playlist rebuild it once
+_rebuild_locks: Dict[str, threading.Lock] = {}
+_rebuild_locks_guard = threading.Lock()
+
+
+@dataclass
+class CatalogSnapshot:
+    playlist_id: str
+    version: int
+    raw: bytes
+    gz: bytes
+    br: Optional[bytes]
+
+    def body(self, encoding: Optional[str]) -> bytes:
+        if encoding == "br" and self.br is not None:
+            return self.br
+        if encoding == "gzip":
+            return self.gz
+        return self.raw
+
+
+def _accepted_codings(accept_encoding: str) -> Dict[str, float]:
+    """Accept-Encoding as coding -> q; an unparsable q counts as 0."""
+    out: Dict[str, float] = {}
+    for part in (accept_encoding or "").lower().split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        out[coding] = q
+    return out
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Highest-q precompressed encoding the client accepts (br on a tie); None = identity."""
+    accepted = _accepted_codings(accept_encoding)
+    best, best_q = None, 0.0
+    for coding in (("br",) if brotli is not None else ()) + ("gzip",):
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def _catalog_dir() -> str:
+    return os.getenv("CATALOG_DIR", os.path.join(tempfile.gettempdir(), "kadr_catalog"))
+
+
+def _path(playlist_id: str, version: int, ext: str) -> str:
+    return os.path.join(_catalog_dir(), f"{playlist_id}-v{version}.json{ext}")
+
+
+def _brotli_quality() -> int:
+    # 11 costs seconds on a large catalog for a few % over 5
+    return int(os.getenv("CATALOG_BROTLI_QUALITY", "5"))
+
+
+def _serialize(playlist_id: str, version: int, items: List[dict]) -> bytes:
+    groups = sorted({it["grp"] for it in items if it.get("grp")})
+    body = {"playlist_id": playlist_id, "version": version, "groups": groups, "items": items}
+    return json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _write(path: str, data: bytes) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build_catalog_snapshot(playlist_id: str, version: int, items: Iterable[dict]) -> CatalogSnapshot:
+    """Serialize + compress once; keep it in memory and write it to disk (best effort)."""
+    items = sorted(
+        ({k: it.get(k) for k in _ITEM_FIELDS} for it in items),
+        key=lambda it: (it["grp"] or "", it["name"], it["tvg_id"]),
+    )
+    raw = _serialize(playlist_id, version, items)
+    snap = CatalogSnapshot(
+        playlist_id=playlist_id,
+        version=version,
+        raw=raw,
+        gz=gzip.compress(raw, compresslevel=9, mtime=0),
+        br=brotli.compress(raw, quality=_brotli_quality()) if brotli is not None else None,
+    )
+    _snapshots.set((playlist_id, version), snap)
+    try:
+        os.makedirs(_catalog_dir(), exist_ok=True)
+        _write(_path(playlist_id, version, ""), snap.raw)
+        _write(_path(playlist_id, version, ".gz"), snap.gz)
+        if snap.br is not None:
+            _write(_path(playlist_id, version, ".br"), snap.br)
+        _remove_older(playlist_id, version)
+    except OSError:
+        pass
+    return snap
+
+
+def _remove_older(playlist_id: str, version: int) -> None:
+    """Delete snapshot files of earlier versions of the playlist."""
+    pattern = re.compile(re.escape(playlist_id) + r"-v(\d+)\.json(\.gz|\.br)?$")
+    for name in os.listdir(_catalog_dir()):
+        m = pattern.match(name)
+        if m and int(m.group(1)) < version:
+            _snapshots.invalidate((playlist_id, int(m.group(1))))
+            try:
+                os.remove(os.path.join(_catalog_dir(), name))
+            except OSError:
+                pass
+
+
+def _load_from_disk(playlist_id: str, version: int) -> Optional[CatalogSnapshot]:
+    try:
+        with open(_path(playlist_id, version, ""), "rb") as f:
+            raw = f.read()
+        with open(_path(playlist_id, version, ".gz"), "rb") as f:
+            gz = f.read()
+        br = None
+        if brotli is not None:
+            if os.path.exists(_path(playlist_id, version, ".br")):
+                with open(_path(playlist_id, version, ".br"), "rb") as f:
+                    br = f.read()
+            else:
+                br = brotli.compress(raw, quality=_brotli_quality())
+    except OSError:
+        return None
+    return CatalogSnapshot(playlist_id=playlist_id, version=version, raw=raw, gz=gz, br=br)
+
+
+def _rebuild_lock(playlist_id: str) -> threading.Lock:
+    with _rebuild_locks_guard:
+        return _rebuild_locks.setdefault(playlist_id, threading.Lock())
+
+
+def get_catalog_snapshot(playlist_id: str, version: int) -> CatalogSnapshot:
+    snap = _snapshots.get((playlist_id, version))
+    if snap is not None:
+        return snap
+    # single flight: the first miss loads/rebuilds, concurrent ones wait and reuse it
+    with _rebuild_lock(playlist_id):
+        snap = _snapshots.get((playlist_id, version))
+        if snap is not None:
+            return snap
+        snap = _load_from_disk(playlist_id, version)
+        if snap is not None:
+            _snapshots.set((playlist_id, version), snap)
+            return snap
+        # another worker ingested it, or the disk was wiped: rebuild from the DB
+        with db() as conn:
+            rows = conn.execute(
+                text("SELECT playlist_id, tvg_id, name, tvg_name, logo, grp, stream_url FROM channels WHERE playlist_id=:pid"),
+                {"pid": playlist_id},
+            ).mappings().all()
+        return build_catalog_snapshot(playlist_id, version, (dict(r) for r in rows))
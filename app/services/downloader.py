@@ -1,3 +1,5 @@
+from typing import AsyncIterator, Dict, Optional
+
 import aiohttp
 
 async def download_bytes(url: str, timeout_total: int = 90) -> bytes:
@@ -6,3 +8,24 @@ async def download_bytes(url: str, timeout_total: int = 90) -> bytes:
         async with session.get(url) as resp:
             resp.raise_for_status()
             return await resp.read()
+
+async def iter_chunks(url: str, timeout_total: Optional[int] = None, timeout_read: int = 60,
+                      chunk_size: int = 64 * 1024, headers: Optional[Dict[str, str]] = None,
+                      info: Optional[dict] = None) -> AsyncIterator[bytes]:
+    """
+    Stream the response body chunk by chunk; nothing is buffered beyond one chunk.
+    If `info` is given it is filled with status/etag/last_modified before the first chunk.
+    A 304 answer to a conditional request yields nothing.
+    """
+    timeout = aiohttp.ClientTimeout(total=timeout_total, sock_read=timeout_read)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.get(url, headers=headers) as resp:
+            if info is not None:
+                info["status"] = resp.status
+                info["etag"] = resp.headers.get("ETag")
+                info["last_modified"] = resp.headers.get("Last-Modified")
+            if resp.status == 304:
+                return
+            resp.raise_for_status()
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                yield chunk
@@ -0,0 +1,264 @@
+"""
+In-process now/next index.
+
+Per EPG source, programmes are packed into flat arrays sorted by (tvg_id, start, stop):
+start/stop epochs in array('q'), titles and descriptions concatenated into one
+str with an offsets array. Each channel maps to a [lo, hi) slice, and now/next
+is a bisect over that slice. Indexes are rebuilt from epg_programmes after a
+refresh and swapped in together with the playlist -> source map by replacing
+one reference, so readers never see a half-built index. A playlist whose
+source is not indexed (cold, or over the memory budget) is answered by SQL;
+one known to have no source (no url-tvg) is skipped, it has no guide either way.
+
+Other workers refresh sources too, so sync_with_db() periodically re-reads the
+playlist -> source map and drops indexes older than their source's changed_at.
+"""
+import os
+import sys
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from app.db import db, without_timeouts
+
+
+class SourceIndex:
+    __slots__ = ("source_id", "channels", "starts", "stops", "offsets", "blob", "built_at", "nbytes")
+
+    def __init__(self, source_id: str) -> None:
+        self.source_id = source_id
+        self.channels: Dict[str, Tuple[int, int]] = {}
+        self.starts = array("q")
+        self.stops = array("q")
+        # title_i = blob[offsets[2i]:offsets[2i+1]], desc_i = blob[offsets[2i+1]:offsets[2i+2]]
+        self.offsets = array("q", [0])
+        self.blob = ""
+        self.built_at = datetime.now(timezone.utc)
+        self.nbytes = 0
+
+    def _programme(self, i: int) -> Dict[str, Any]:
+        o = self.offsets
+        title = self.blob[o[2 * i]:o[2 * i + 1]]
+        desc = self.blob[o[2 * i + 1]:o[2 * i + 2]]
+        return {
+            "title": title or None,
+            "desc": desc or None,
+            "start": datetime.fromtimestamp(self.starts[i], tz=timezone.utc).isoformat(),
+            "stop": datetime.fromtimestamp(self.stops[i], tz=timezone.utc).isoformat(),
+        }
+
+    def now_next(self, tvg_id: str, now_ts: int) -> Optional[Tuple[Optional[dict], Optional[dict]]]:
+        """(now, next) for the channel, or None if the source has no guide for it."""
+        span = self.channels.get(tvg_id)
+        if span is None:
+            return None
+        lo, hi = span
+        i = bisect_right(self.starts, now_ts, lo, hi)  # first programme starting after now
+        cur = self._programme(i - 1) if i > lo and self.stops[i - 1] > now_ts else None
+        nxt = self._programme(i) if i < hi else None
+        if cur is None and nxt is None:
+            return None
+        return cur, nxt
+
+
+# (source_id -> index, playlist_id -> source_id or None for "no guide"); replaced as a whole
+_state: Tuple[Dict[str, SourceIndex], Dict[str, Optional[str]]] = ({}, {})
+_build_lock = threading.Lock()
+
+
+def _budget_bytes() -> int:
+    return int(float(os.getenv("EPG_INDEX_MAX_MB", "256")) * 1024 * 1024)
+
+
+def _used_bytes(indexes: Dict[str, SourceIndex], exclude: str = "") -> int:
+    return sum(ix.nbytes for sid, ix in indexes.items() if sid != exclude)
+
+
+def _build(source_id: str, rows: Iterable, budget: int) -> Optional[SourceIndex]:
+    ix = SourceIndex(source_id)
+    parts: List[str] = []
+    pos = 0
+    cur_tvg: Optional[str] = None
+    lo = 0
+    n = 0
+    approx = 0
+    for tvg_id, start, stop, title, desc in rows:
+        if tvg_id != cur_tvg:
+            if cur_tvg is not None:
+                ix.channels[cur_tvg] = (lo, n)
+            cur_tvg, lo = tvg_id, n
+            approx += sys.getsizeof(tvg_id) + 120  # key + tuple + dict slot
+        ix.starts.append(int(start.timestamp()))
+        ix.stops.append(int(stop.timestamp()))
+        title = title or ""
+        desc = desc or ""
+        parts.append(title)
+        parts.append(desc)
+        pos += len(title)
+        ix.offsets.append(pos)
+        pos += len(desc)
+        ix.offsets.append(pos)
+        n += 1
+        approx += 32 + len(title) + len(desc)
+        if approx > budget:
+            return None
+    if cur_tvg is not None:
+        ix.channels[cur_tvg] = (lo, n)
+    ix.blob = "".join(parts)
+    ix.nbytes = (sys.getsizeof(ix.blob) + ix.starts.itemsize * len(ix.starts) * 2
+                 + ix.offsets.itemsize * len(ix.offsets) + sys.getsizeof(ix.channels)
+                 + sum(sys.getsizeof(k) + 64 for k in ix.channels))
+    return ix if ix.nbytes <= budget else None
+
+
+def rebuild(source_id: str, playlist_ids: List[str]) -> bool:
+    """
+    Load the source's remaining guide from the DB and swap its index in; the
+    playlists are mapped to it. Blocking; run off the loop. False = over budget.
+    The load runs unlocked; _build_lock only covers the swap, so the callers on
+    the event loop (map_playlists, retain) never wait for a scan.
+    """
+    global _state
+    since = datetime.now(timezone.utc) - timedelta(hours=1)
+    budget = _budget_bytes()
+    with db() as conn:
+        without_timeouts(conn)
+        res = conn.execution_options(yield_per=10000).execute(
+            text("SELECT tvg_id, start_utc, stop_utc, title, description FROM epg_programmes "
+                 "WHERE source_id=:sid AND stop_utc > :since ORDER BY tvg_id, start_utc, stop_utc"),
+            {"sid": source_id, "since": since},
+        )
+        ix = _build(source_id, res, budget - _used_bytes(_state[0], exclude=source_id))
+    with _build_lock:
+        indexes, source_of = _state
+        cur = indexes.get(source_id)
+        if ix is not None and cur is not None and cur.built_at > ix.built_at:
+            ix = cur  # a later load of the same source already swapped in
+        # other sources may have been swapped in meanwhile: recheck the budget against them
+        if ix is not None and _used_bytes(indexes, exclude=source_id) + ix.nbytes > budget:
+            ix = None
+        indexes = {k: v for k, v in indexes.items() if k != source_id}
+        if ix is not None:
+            indexes[source_id] = ix  # else over budget: stale copy dropped, SQL answers for this source
+        _state = (indexes, {**source_of, **{pid: source_id for pid in playlist_ids}})
+        return ix is not None
+
+
+def retain(sources: Dict[str, List[str]]) -> None:
+    """
+    Keep only the given sources (source_id -> playlist_ids) and their playlists.
+    Playlists known to have no guide stay mapped to None; sync_with_db() refreshes those.
+    """
+    global _state
+    with _build_lock:
+        indexes, source_of = _state
+        _state = (
+            {k: v for k, v in indexes.items() if k in sources},
+            {**{pid: None for pid, sid in source_of.items() if sid is None},
+             **{pid: sid for sid, pids in sources.items() for pid in pids}},
+        )
+
+
+def is_warm(source_id: str) -> bool:
+    return source_id in _state[0]
+
+
+def is_fresh(source_id: str, changed_at: Optional[datetime]) -> bool:
+    """Indexed, and built after the source's guide last changed (in any worker)."""
+    ix = _state[0].get(source_id)
+    return ix is not None and (changed_at is None or changed_at <= ix.built_at)
+
+
+def map_playlists(source_id: str, playlist_ids: List[str]) -> None:
+    """Point the playlists at the source without rebuilding anything."""
+    global _state
+    with _build_lock:
+        indexes, source_of = _state
+        if all(source_of.get(pid) == source_id for pid in playlist_ids):
+            return
+        _state = (indexes, {**source_of, **{pid: source_id for pid in playlist_ids}})
+
+
+def forget_playlist(playlist_id: str) -> None:
+    """Its source changed: answer it by SQL until the new source is mapped."""
+    global _state
+    with _build_lock:
+        indexes, source_of = _state
+        if playlist_id in source_of:
+            _state = (indexes, {k: v for k, v in source_of.items() if k != playlist_id})
+
+
+def sync_with_db() -> Dict[str, List[str]]:
+    """
+    Re-read current playlist -> source from the DB and drop indexes whose source
+    changed after they were built. Returns the dropped sources (source_id -> playlist_ids)
+    so the caller can rebuild them; until then SQL answers for them.
+    """
+    global _state
+    with db() as conn:
+        rows = conn.execute(text(
+            "SELECT p.id, s.id, s.changed_at FROM playlists p "
+            "JOIN package_current_playlist c ON c.playlist_id = p.id "
+            "LEFT JOIN epg_sources s ON s.id = p.epg_source_id"
+        )).all()
+    source_of = {pid: sid for pid, sid, _ in rows}  # None: no url-tvg, the playlist has no guide
+    changed_at = {sid: ca for _, sid, ca in rows if sid is not None}
+    stale: Dict[str, List[str]] = {}
+    with _build_lock:
+        indexes, _ = _state
+        kept = {}
+        for sid, ix in indexes.items():
+            if sid not in changed_at:
+                continue  # no current playlist uses it any more
+            if changed_at[sid] is not None and changed_at[sid] > ix.built_at:
+                stale[sid] = [pid for pid, s in source_of.items() if s == sid]
+                continue
+            kept[sid] = ix
+        _state = (kept, source_of)
+    return stale
+
+
+def now_next(playlist_ids: List[str], tvg_ids: List[str], now: datetime) -> Optional[List[Dict[str, Any]]]:
+    """
+    Same result as epg_service.now_next_batch, or None if any playlist is unknown here
+    or its source is cold. Playlists known to have no guide are skipped.
+    """
+    indexes, source_of = _state  # one consistent snapshot for the whole call
+    ixs = []
+    for pid in playlist_ids:
+        if pid not in source_of:
+            return None
+        sid = source_of[pid]
+        if sid is None:
+            continue
+        ix = indexes.get(sid)
+        if ix is None:
+            return None
+        ixs.append((pid, ix))
+    now_ts = int(now.timestamp())
+    out = []
+    for tvg in tvg_ids:
+        item = {"tvg_id": tvg, "playlist_id": None, "now": None, "next": None}
+        for pid, ix in ixs:
+            hit = ix.now_next(tvg, now_ts)
+            if hit is not None:
+                item["playlist_id"] = pid
+                item["now"], item["next"] = hit
+                break
+        out.append(item)
+    return out
+
+
+def stats() -> Dict[str, Any]:
+    indexes, source_of = _state
+    return {
+        "sources": len(indexes),
+        "playlists": len(source_of),
+        "programmes": sum(len(ix.starts) for ix in indexes.values()),
+        "bytes": _used_bytes(indexes),
+        "budget_bytes": _budget_bytes(),
+    }
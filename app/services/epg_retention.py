@@ -0,0 +1,215 @@
+"""
+EPG retention window and daily partitions of epg_programmes.
+
+epg_programmes is range-partitioned by start_utc, one partition per UTC day,
+with no default partition: ingest only keeps programmes inside the retention
+window (EPG_RETAIN_PAST_HOURS back, EPG_RETAIN_FUTURE_DAYS ahead), and the
+partitions for that window are created on demand. Old days are removed by
+detaching and dropping their partition, not by DELETE + vacuum.
+
+DETACH / CREATE ... PARTITION OF take ACCESS EXCLUSIVE on epg_programmes, so
+each runs in its own short transaction with a lock_timeout: readers wait for
+a catalog change at most, never for a scan, and a busy table just means the
+step is retried on the next run.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
+
+from app.db import db
+
+_PREFIX = "epg_programmes_p"
+# orphan programmes deleted per transaction
+_ORPHAN_BATCH = 10000
+
+
+def retention_window(now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """(keep_from, keep_to): programmes must end after keep_from and start before keep_to."""
+    now = now or datetime.now(timezone.utc)
+    past = timedelta(hours=float(os.getenv("EPG_RETAIN_PAST_HOURS", "24")))
+    future = timedelta(days=float(os.getenv("EPG_RETAIN_FUTURE_DAYS", "7")))
+    return now - past, now + future
+
+
+def _day(dt: datetime) -> datetime:
+    return dt.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def partition_range(now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """[lo, hi) covered by partitions for the current window, whole UTC days."""
+    keep_from, keep_to = retention_window(now)
+    return _day(keep_from), _day(keep_to) + timedelta(days=1)
+
+
+def _name(day: datetime) -> str:
+    return f"{_PREFIX}{day:%Y%m%d}"
+
+
+def _days(lo: datetime, hi: datetime) -> List[datetime]:
+    days: List[datetime] = []
+    d = _day(lo)
+    while d < hi:
+        days.append(d)
+        d += timedelta(days=1)
+    return days
+
+
+def _existing(conn: Connection, days: List[datetime]) -> set:
+    return set(conn.execute(
+        text("SELECT relname FROM pg_class WHERE relname = ANY(:names)"), {"names": [_name(d) for d in days]}
+    ).scalars().all())
+
+
+def ensure_partitions(conn: Connection, lo: datetime, hi: datetime) -> int:
+    """Create missing daily partitions covering [lo, hi). Returns how many were created."""
+    days = _days(lo, hi)
+    existing = _existing(conn, days)
+    created = 0
+    for d in days:
+        if _name(d) in existing:
+            continue
+        # CREATE ... PARTITION OF locks the parent, so only run it for days that are really missing
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {_name(d)} PARTITION OF epg_programmes "
+            f"FOR VALUES FROM ('{d:%Y-%m-%d} 00:00:00+00') TO ('{d + timedelta(days=1):%Y-%m-%d} 00:00:00+00')"
+        ))
+        created += 1
+    return created
+
+
+def covered_until(conn: Connection, lo: datetime, hi: datetime) -> datetime:
+    """End of the run of existing daily partitions starting at lo (at most hi); no DDL."""
+    days = _days(lo, hi)
+    existing = _existing(conn, days)
+    for d in days:
+        if _name(d) not in existing:
+            return d
+    return hi
+
+
+def _partitions(conn: Connection) -> List[str]:
+    return conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'epg_programmes'::regclass ORDER BY c.relname"
+    )).scalars().all()
+
+
+def _ddl_lock_timeout(conn: Connection) -> None:
+    conn.execute(text("SELECT set_config('lock_timeout', :t, true)"), {"t": os.getenv("EPG_DDL_LOCK_TIMEOUT", "2s")})
+
+
+def create_partitions(lo: datetime, hi: datetime) -> int:
+    """ensure_partitions() in its own short transaction under the DDL lock_timeout (OperationalError if busy)."""
+    with db() as conn:
+        _ddl_lock_timeout(conn)
+        return ensure_partitions(conn, lo, hi)
+
+
+def prune_epg(now: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Periodic cleanup: drop partitions older than the window and create the upcoming
+    ones, one short transaction per partition. One day past the window is created
+    too, so ingests after UTC midnight find their partitions and never need DDL. Old guides of unused sources are
+    removed separately by prune_orphan_programmes().
+    """
+    lo, hi = partition_range(now)
+    dropped: List[str] = []
+    skipped: List[str] = []
+    with db() as conn:
+        names = _partitions(conn)
+    for name in names:
+        try:
+            day = datetime.strptime(name[len(_PREFIX):], "%Y%m%d").replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue  # not one of ours
+        if day + timedelta(days=1) > lo:
+            continue
+        try:
+            # together, so a failure never leaves a detached table behind; both are catalog-only
+            with db() as conn:
+                _ddl_lock_timeout(conn)
+                conn.execute(text(f"ALTER TABLE epg_programmes DETACH PARTITION {name}"))
+                conn.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+        except OperationalError:
+            skipped.append(name)  # lock not granted in time: next run
+    created = create_partitions(lo, hi + timedelta(days=1))
+    return {"dropped_partitions": dropped, "skipped_partitions": skipped, "created_partitions": created}
+
+
+def prune_orphan_programmes(batch: int = _ORPHAN_BATCH) -> int:
+    """
+    Delete the stored guide of sources no current playlist uses any more, source by
+    source on the primary key, `batch` rows per transaction. Returns rows deleted.
+    """
+    with db() as conn:
+        orphans = conn.execute(text(
+            "SELECT s.id FROM epg_sources s WHERE NOT EXISTS ("
+            "SELECT 1 FROM playlists p JOIN package_current_playlist c ON c.playlist_id = p.id "
+            "WHERE p.epg_source_id = s.id)"
+        )).scalars().all()
+    deleted = 0
+    for source_id in orphans:
+        while True:
+            with db() as conn:
+                n = conn.execute(text(
+                    "DELETE FROM epg_programmes e USING ("
+                    "  SELECT tvg_id, start_utc, stop_utc FROM epg_programmes WHERE source_id=:sid LIMIT :n"
+                    ") d WHERE e.source_id=:sid AND e.tvg_id=d.tvg_id AND e.start_utc=d.start_utc "
+                    "AND e.stop_utc=d.stop_utc"
+                ), {"sid": source_id, "n": batch}).rowcount
+            deleted += n
+            if n < batch:
+                break
+    return deleted
+
+
+def partition_by_source(conn: Connection) -> None:
+    """
+    Migration step: move the per-playlist epg_programmes table into the per-source,
+    daily-partitioned one. Playlists sharing a guide each had a copy; the newest
+    playlist's row wins. Rows outside the window (no partition) and of playlists
+    without a source are dropped.
+    """
+    converted = conn.execute(text(
+        "SELECT 1 FROM information_schema.columns WHERE table_name='epg_programmes' AND column_name='source_id'"
+    )).first()
+    if converted:
+        return
+    conn.execute(text("ALTER TABLE epg_programmes RENAME TO epg_programmes_old"))
+    conn.execute(text("ALTER INDEX IF EXISTS epg_programmes_pkey RENAME TO epg_programmes_old_pkey"))
+    conn.execute(text(
+        """
+        CREATE TABLE epg_programmes(
+            source_id TEXT NOT NULL,
+            tvg_id TEXT NOT NULL,
+            start_utc TIMESTAMPTZ NOT NULL,
+            stop_utc TIMESTAMPTZ NOT NULL,
+            title TEXT,
+            description TEXT,
+            PRIMARY KEY (source_id, tvg_id, start_utc, stop_utc)
+        ) PARTITION BY RANGE (start_utc)
+        """
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS epg_programmes_grid_idx ON epg_programmes "
+        "USING gist (source_id, tvg_id, tstzrange(start_utc, stop_utc))"
+    ))
+    lo, hi = partition_range()
+    keep_from, _ = retention_window()
+    ensure_partitions(conn, lo, hi)
+    conn.execute(
+        text("INSERT INTO epg_programmes(source_id, tvg_id, start_utc, stop_utc, title, description) "
+             "SELECT DISTINCT ON (p.epg_source_id, o.tvg_id, o.start_utc, o.stop_utc) "
+             "p.epg_source_id, o.tvg_id, o.start_utc, o.stop_utc, o.title, o.description "
+             "FROM epg_programmes_old o JOIN playlists p ON p.id = o.playlist_id "
+             "WHERE p.epg_source_id IS NOT NULL "
+             "AND o.start_utc >= :lo AND o.start_utc < :hi AND o.stop_utc > :keep_from "
+             "ORDER BY p.epg_source_id, o.tvg_id, o.start_utc, o.stop_utc, p.created_at DESC"),
+        {"lo": lo, "hi": hi, "keep_from": keep_from},
+    )
+    conn.execute(text("DROP TABLE epg_programmes_old"))
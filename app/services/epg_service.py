@@ -1,81 +1,636 @@
-from datetime import datetime, timezone
-from typing import Dict, Any, List
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+from dataclasses import replace
+from typing import Dict, Any, List, AsyncIterator, Callable, Iterable, Iterator, Optional, Tuple, Union
 
 from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
 
-from app.db import db
-from app.parsers.xmltv import iter_programmes_from_bytes
-from app.services.downloader import download_bytes
+from app.db import adb, advisory_lock, db, copy_rows, without_timeouts
+from app.parsers.xmltv import Programme, XmltvStreamParser
+from app.services import epg_index
+from app.services.epg_retention import covered_until, create_partitions, partition_range, retention_window
+from app.services.epg_sources import current_playlists_by_source, ensure_epg_source, get_epg_source
+from app.services.downloader import iter_chunks
 
-def _maybe_decompress(data: bytes) -> bytes:
-    # gzip magic header
-    if data[:2] == b"\x1f\x8b":
-        import gzip
-        return gzip.decompress(data)
-    return data
+_STAGE_COLUMNS = ("stage_id", "tvg_id", "start_utc", "stop_utc", "title", "description", "content_hash")
 
-async def refresh_epg_for_playlist(playlist_id: str, epg_url: str) -> Dict[str, Any]:
-    raw = await download_bytes(epg_url, timeout_total=120)
-    xml_bytes = _maybe_decompress(raw)
+def _epg_batch_size() -> int:
+    return int(os.getenv("EPG_COPY_BATCH", "50000"))
+
+def _ingest_mode() -> str:
+    # diff: apply only changed rows; replace: delete + reinsert the whole guide
+    return "replace" if os.getenv("EPG_INGEST_MODE", "diff").lower() == "replace" else "diff"
+
+def programme_hash(p: Programme) -> str:
+    raw = "\x1f".join((p.tvg_id, str(p.start_utc), str(p.stop_utc), p.title or "", p.desc or ""))
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def _copy_staged(conn, stage_id: str, programmes: List[Programme]) -> int:
+    return copy_rows(
+        conn,
+        "epg_programmes_staging",
+        _STAGE_COLUMNS,
+        ((stage_id, p.tvg_id, p.start_utc, p.stop_utc, p.title, p.desc, programme_hash(p)) for p in programmes),
+    )
+
+# channel key (casefolded tvg_id / tvg_name) -> playlist tvg_ids it feeds
+ChannelFilter = Dict[str, Tuple[str, ...]]
+
+def _channel_key(s: str) -> str:
+    return s.strip().casefold()
+
+def _load_channel_filter(playlist_ids: List[str]) -> Optional[ChannelFilter]:
+    """
+    XMLTV channel ids the playlists can show: each channel's tvg_id, plus its
+    tvg_name as an alias (remapped to the tvg_id). None = keep everything.
+    """
+    if os.getenv("EPG_FILTER_CHANNELS", "1") == "0":
+        return None
+    with db() as conn:
+        rows = conn.execute(
+            text("SELECT tvg_id, tvg_name FROM channels WHERE playlist_id = ANY(:pids)"), {"pids": playlist_ids}
+        ).all()
+    if not rows:
+        return None  # no channels yet: don't throw the whole guide away
+    wanted: Dict[str, set] = defaultdict(set)
+    for tvg_id, tvg_name in rows:
+        for alias in (tvg_id, tvg_name):
+            if alias and alias.strip():
+                wanted[_channel_key(alias)].add(tvg_id)
+    return {k: tuple(sorted(v)) for k, v in wanted.items()}
+
+def _filter_fingerprint(wanted: Optional[ChannelFilter]) -> str:
+    """Identifies the channel set a stored guide was filtered with ("*" = unfiltered)."""
+    if wanted is None:
+        return "*"
+    h = hashlib.sha256()
+    for key in sorted(wanted):
+        h.update(f"{key}\t{','.join(wanted[key])}\n".encode("utf-8"))
+    return h.hexdigest()
+
+def _apply_filter(programmes: List[Programme], wanted: ChannelFilter) -> Tuple[List[Programme], int]:
+    kept: List[Programme] = []
+    dropped = 0
+    for p in programmes:
+        targets = wanted.get(_channel_key(p.tvg_id))
+        if targets is None:
+            dropped += 1
+            continue
+        for tvg_id in targets:
+            kept.append(p if tvg_id == p.tvg_id else replace(p, tvg_id=tvg_id))
+    return kept, dropped
+
+def _stage_chunks(stage_id: str, chunks: Iterable[bytes], report: Callable[[str, int], None],
+                  wanted: Optional[ChannelFilter] = None) -> Tuple[int, int]:
+    """
+    Gunzip -> parse -> filter -> COPY, one chunk at a time.
+    Only the staging table is written; at most one batch is held in memory.
+    Returns (staged, dropped); dropped = programmes for channels not in `wanted`.
+    """
+    parser = XmltvStreamParser()
+    size = _epg_batch_size()
+    staged = 0
+    dropped = 0
+    pending: List[Programme] = []
+
+    def take(programmes: List[Programme]) -> None:
+        nonlocal dropped
+        if wanted is not None:
+            programmes, n = _apply_filter(programmes, wanted)
+            dropped += n
+        pending.extend(programmes)
+
+    with db() as conn:
+        without_timeouts(conn)
+        conn.execute(text("DELETE FROM epg_programmes_staging WHERE stage_id=:sid"), {"sid": stage_id})
+        for chunk in chunks:
+            take(parser.feed(chunk))
+            if len(pending) >= size:
+                staged += _copy_staged(conn, stage_id, pending)
+                pending.clear()
+                report("staging", staged)
+        take(parser.close())
+        staged += _copy_staged(conn, stage_id, pending)
+    return staged, dropped
+
+def _drop_staged(stage_id: str) -> None:
+    with db() as conn:
+        conn.execute(text("DELETE FROM epg_programmes_staging WHERE stage_id=:sid"), {"sid": stage_id})
+
+# staged rows of one ingest inside the retention window, one per key
+_STAGED_CTE = (
+    "WITH s AS ("
+    "  SELECT DISTINCT ON (tvg_id, start_utc, stop_utc) tvg_id, start_utc, stop_utc, title, description, content_hash "
+    "  FROM epg_programmes_staging "
+    "  WHERE stage_id=:sid AND stop_utc >= start_utc "
+    "  AND start_utc >= :lo AND start_utc < :keep_to AND stop_utc > :keep_from"
+    ") "
+)
+
+def _replace_staged(conn, params: Dict[str, Any]) -> Dict[str, int]:
+    deleted = conn.execute(text("DELETE FROM epg_programmes WHERE source_id=:src"), params).rowcount
+    inserted = conn.execute(
+        text(_STAGED_CTE + "INSERT INTO epg_programmes(source_id, tvg_id, start_utc, stop_utc, title, description, content_hash) "
+             "SELECT :src, s.tvg_id, s.start_utc, s.stop_utc, s.title, s.description, s.content_hash FROM s "
+             "ON CONFLICT (source_id, tvg_id, start_utc, stop_utc) DO NOTHING"),
+        params,
+    ).rowcount
+    return {"inserted": inserted, "updated": 0, "deleted": deleted}
+
+def _diff_staged(conn, params: Dict[str, Any]) -> Dict[str, int]:
+    # rows that ended before the window are left to the partition pruner
+    deleted = conn.execute(
+        text(_STAGED_CTE + "DELETE FROM epg_programmes e WHERE e.source_id=:src AND e.stop_utc > :keep_from "
+             "AND NOT EXISTS (SELECT 1 FROM s WHERE s.tvg_id=e.tvg_id AND s.start_utc=e.start_utc AND s.stop_utc=e.stop_utc)"),
+        params,
+    ).rowcount
+    updated = conn.execute(
+        text(_STAGED_CTE + "UPDATE epg_programmes e SET title=s.title, description=s.description, content_hash=s.content_hash "
+             "FROM s WHERE e.source_id=:src AND e.tvg_id=s.tvg_id AND e.start_utc=s.start_utc AND e.stop_utc=s.stop_utc "
+             "AND e.content_hash IS DISTINCT FROM s.content_hash"),
+        params,
+    ).rowcount
+    inserted = conn.execute(
+        text(_STAGED_CTE + "INSERT INTO epg_programmes(source_id, tvg_id, start_utc, stop_utc, title, description, content_hash) "
+             "SELECT :src, s.tvg_id, s.start_utc, s.stop_utc, s.title, s.description, s.content_hash FROM s "
+             "ON CONFLICT (source_id, tvg_id, start_utc, stop_utc) DO NOTHING"),
+        params,
+    ).rowcount
+    return {"inserted": inserted, "updated": updated, "deleted": deleted}
+
+def _swap_staged(stage_id: str, source_id: str) -> Dict[str, int]:
+    """
+    Apply the staged rows to the source's guide in one short transaction:
+    only the changed rows in diff mode, everything in replace mode.
+    Readers keep seeing the old rows until commit. Only programmes inside the
+    retention window and its existing partitions are kept (there is no default
+    partition for the rest). Missing partitions are created beforehand in their
+    own lock_timeout'd transaction, so the swap never holds ACCESS EXCLUSIVE.
+    """
+    lo, hi = partition_range()
+    keep_from, keep_to = retention_window()
+    try:
+        create_partitions(lo, hi)  # normally a lookup only: prune_epg keeps a day ahead
+    except OperationalError:
+        pass  # parent busy: store what the existing partitions cover, the next run fills the rest
+    with db() as conn:
+        without_timeouts(conn)
+        params = {"src": source_id, "sid": stage_id, "lo": lo, "keep_from": keep_from,
+                  "keep_to": min(keep_to, covered_until(conn, lo, hi))}
+        if _ingest_mode() == "diff":
+            counts = _diff_staged(conn, params)
+        else:
+            counts = _replace_staged(conn, params)
+        conn.execute(text("DELETE FROM epg_programmes_staging WHERE stage_id=:sid"), {"sid": stage_id})
+        return counts
+
+def _hashed(chunks: Iterable[bytes], h) -> Iterator[bytes]:
+    for chunk in chunks:
+        h.update(chunk)
+        yield chunk
+
+def _ingest_chunks(stage_id: str, source_id: str, wanted: Optional[ChannelFilter], chunks: Iterable[bytes],
+                   report: Callable[[str, int], None]) -> Dict[str, Any]:
+    # runs in a worker thread/process: parsing and DB writes never touch the event loop
+    h = hashlib.sha256()
+    staged, dropped = _stage_chunks(stage_id, _hashed(chunks, h), report, wanted)
+    sha256 = h.hexdigest()
+    if not staged:
+        # nothing parsed: leave epg_programmes alone
+        _drop_staged(stage_id)
+        return {"staged": staged, "dropped": dropped, "inserted": 0, "updated": 0, "deleted": 0,
+                "sha256": sha256, "swapped": False, "changed": False}
+    report("swapping", staged)
+    counts = _swap_staged(stage_id, source_id)
+    return {"staged": staged, "dropped": dropped, **counts, "sha256": sha256, "swapped": True,
+            "changed": any(counts.values())}
+
+def _iter_file(path: str, chunk_size: int = 256 * 1024) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+def _ingest_file(stage_id: str, source_id: str, wanted: Optional[ChannelFilter], path: str,
+                 progress_q) -> Dict[str, Any]:
+    # process-pool entry point (must be top-level to be picklable)
+    return _ingest_chunks(stage_id, source_id, wanted, _iter_file(path),
+                          lambda phase, n: progress_q.put((phase, n)))
+
+
+# ---------- Worker pool ----------
+_executor: Optional[Executor] = None
+_manager = None
+_progress: Dict[str, Dict[str, Any]] = {}
+
+def _worker_mode() -> str:
+    mode = os.getenv("EPG_WORKER_MODE", "thread").strip().lower()
+    return mode if mode in ("thread", "process") else "thread"
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is not None:
+        return _executor
+    workers = max(1, int(os.getenv("EPG_WORKERS", "2")))
+    if _worker_mode() == "process":
+        # spawn: children must not inherit the parent's pooled DB connections
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="epg")
+    return _executor
+
+def shutdown_epg_workers() -> None:
+    global _executor, _manager
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    if _manager is not None:
+        _manager.shutdown()
+        _manager = None
+
+def epg_progress() -> Dict[str, Dict[str, Any]]:
+    return {k: dict(v) for k, v in _progress.items()}
+
+def _set_progress(key: str, phase: str, programmes: int) -> None:
+    st = _progress.get(key)
+    if st is not None:
+        st["phase"] = phase
+        st["programmes"] = programmes
+
+async def _prepend(first: bytes, rest: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    try:
+        yield first
+        async for chunk in rest:
+            yield chunk
+    finally:
+        await rest.aclose()
+
+def _bridge(agen: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop) -> Iterator[bytes]:
+    # sync view of an async iterator, pulled from a worker thread; the download stays on the loop
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+async def _run_in_thread(key: str, stage_id: str, source_id: str, wanted: Optional[ChannelFilter],
+                         chunks: Union[AsyncIterator[bytes], str]) -> Dict[str, Any]:
+    """Ingest in a pool thread, straight from the download or from a spooled file (path)."""
+    loop = asyncio.get_running_loop()
+
+    def report(phase: str, n: int) -> None:
+        loop.call_soon_threadsafe(_set_progress, key, phase, n)
+
+    if isinstance(chunks, str):
+        return await loop.run_in_executor(
+            _get_executor(), _ingest_chunks, stage_id, source_id, wanted, _iter_file(chunks), report,
+        )
+    try:
+        return await loop.run_in_executor(
+            _get_executor(), _ingest_chunks, stage_id, source_id, wanted, _bridge(chunks, loop), report,
+        )
+    finally:
+        await chunks.aclose()
+
+async def _run_in_process(key: str, stage_id: str, source_id: str, wanted: Optional[ChannelFilter],
+                          path: str) -> Dict[str, Any]:
+    global _manager
+    loop = asyncio.get_running_loop()
+    if _manager is None:
+        _manager = multiprocessing.get_context("spawn").Manager()
+    progress_q = _manager.Queue()
+    fut = loop.run_in_executor(_get_executor(), _ingest_file, stage_id, source_id, wanted, path, progress_q)
+    while True:
+        done, _ = await asyncio.wait({fut}, timeout=0.5)
+        while not progress_q.empty():
+            _set_progress(key, *progress_q.get_nowait())
+        if done:
+            return fut.result()
+
+async def _spool(chunks: AsyncIterator[bytes], h) -> str:
+    """Write the download to a temp file (bounded memory), hashing it on the way. Caller unlinks."""
+    fd, path = tempfile.mkstemp(prefix="epg_", suffix=".xmltv")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in chunks:
+                h.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
 
-    inserted = 0
-    started_at = datetime.now(timezone.utc)
 
+# ---------- Refresh ----------
+def _save_fetch_state(source_id: str, etag: Optional[str], last_modified: Optional[str], sha256: str,
+                      changed: bool, filter_hash: Optional[str]) -> None:
+    # filter_hash only after a swap: that's when the stored rows were filtered with it
     with db() as conn:
-        conn.execute(text("DELETE FROM epg_programmes WHERE playlist_id=:pid"), {"pid": playlist_id})
-        for p in iter_programmes_from_bytes(xml_bytes):
-            conn.execute(
-                text("INSERT INTO epg_programmes(playlist_id, tvg_id, start_utc, stop_utc, title, desc) "
-                     "VALUES(:pid,:tvg,:start,:stop,:title,:desc) "
-                     "ON CONFLICT (playlist_id, tvg_id, start_utc, stop_utc) DO UPDATE SET title=EXCLUDED.title, desc=EXCLUDED.desc"),
-                {
-                    "pid": playlist_id,
-                    "tvg": p.tvg_id,
-                    "start": p.start_utc.replace("Z","+00:00"),
-                    "stop": p.stop_utc.replace("Z","+00:00"),
-                    "title": p.title,
-                    "desc": p.desc,
-                }
-            )
-            inserted += 1
+        conn.execute(
+            text("UPDATE epg_sources SET etag=:etag, last_modified=:lm, content_sha256=:sha, "
+                 "filter_hash=COALESCE(:fh, filter_hash), changed_at=COALESCE(:ca, changed_at) WHERE id=:id"),
+            {"id": source_id, "etag": etag, "lm": last_modified, "sha": sha256, "fh": filter_hash,
+             "ca": datetime.now(timezone.utc) if changed else None},
+        )
 
+async def _warm_index(source_id: str, playlist_ids: List[str], changed: bool,
+                      changed_at: Optional[datetime] = None) -> None:
+    # rebuild after a swap, for a cold source, or when another worker changed the guide
+    # after this index was built (this worker then only sees a 304 / same hash)
+    if not changed and epg_index.is_fresh(source_id, changed_at):
+        epg_index.map_playlists(source_id, playlist_ids)
+        return
+    try:
+        await asyncio.to_thread(epg_index.rebuild, source_id, playlist_ids)
+    except Exception:
+        pass  # now/next falls back to SQL for cold sources
+
+def _idle_result(source_id: str, epg_url: Optional[str], playlist_ids: List[str], status: str,
+                 started_at: datetime, t0: float) -> Dict[str, Any]:
+    # a refresh that stored nothing (304, empty body, or another refresh of the source in flight)
     return {
-        "playlist_id": playlist_id,
+        "source_id": source_id,
         "epg_url": epg_url,
-        "programmes_inserted": inserted,
+        "playlist_ids": playlist_ids,
+        "status": status,
+        "programmes_staged": 0,
+        "programmes_dropped": 0,
+        "programmes_inserted": 0,
+        "programmes_updated": 0,
+        "programmes_deleted": 0,
+        "mode": _ingest_mode(),
         "started_at": started_at.isoformat(),
+        "seconds": round(time.perf_counter() - t0, 3),
+        "rows_per_sec": None,
     }
 
-def now_next_for_playlists(playlist_ids: List[str], tvg_id: str) -> Dict[str, Any]:
-    now = datetime.now(timezone.utc)
+# one refresh per source at a time in this process; advisory_lock covers the other workers
+_source_locks: Dict[str, asyncio.Lock] = {}
+
+@asynccontextmanager
+async def _single_flight(source_id: str, wait: bool) -> AsyncIterator[bool]:
+    lock = _source_locks.setdefault(source_id, asyncio.Lock())
+    if lock.locked() and not wait:
+        yield False
+        return
+    async with lock:
+        async with advisory_lock(source_id, wait=wait) as got:
+            yield got
+
+async def refresh_epg_source(source_id: str, playlist_ids: List[str], conditional: bool = True) -> Dict[str, Any]:
+    """
+    Download the source's guide once and store it once, for every playlist that references it.
+    With `conditional`, an unchanged guide writes nothing: a 304 costs one request, and a
+    200 whose sha256 matches the last ingest is only spooled to disk and hashed, never staged.
+    Never runs twice at once for a source (in any worker): a conditional (scheduled) refresh
+    is skipped with status "busy", an unconditional (admin) one waits its turn.
+    """
+    started_at = datetime.now(timezone.utc)
+    t0 = time.perf_counter()
+    async with _single_flight(source_id, wait=not conditional) as got:
+        if got:
+            return await _refresh_epg_source(source_id, playlist_ids, conditional, started_at, t0)
+    source = await asyncio.to_thread(get_epg_source, source_id)
+    return _idle_result(source_id, source["url"] if source else None, playlist_ids, "busy", started_at, t0)
+
+async def _refresh_epg_source(source_id: str, playlist_ids: List[str], conditional: bool,
+                              started_at: datetime, t0: float) -> Dict[str, Any]:
+    stage_id = f"stg_{uuid.uuid4().hex[:12]}"
+
+    source = await asyncio.to_thread(get_epg_source, source_id)
+    if source is None:
+        raise ValueError(f"unknown epg source {source_id}")
+    epg_url = source["url"]
+    wanted = await asyncio.to_thread(_load_channel_filter, playlist_ids)
+    filter_hash = _filter_fingerprint(wanted)
+    # the stored guide was filtered for another channel set (e.g. an upload added channels):
+    # a 304 or the same file still means different rows, so fetch and ingest unconditionally
+    state = source if conditional and source.get("filter_hash") == filter_hash else None
+    headers: Dict[str, str] = {}
+    if state and state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state and state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+    known_sha256 = state.get("content_sha256") if state else None
+
+    info: Dict[str, Any] = {}
+    chunks = iter_chunks(epg_url, headers=headers or None, info=info)
+    first = await anext(chunks, None)
+    if first is None:
+        # 304 Not Modified (or an empty body): one request, no DB writes
+        await chunks.aclose()
+        await _warm_index(source_id, playlist_ids, changed=False, changed_at=source.get("changed_at"))
+        return _idle_result(source_id, epg_url, playlist_ids, "not_modified" if info.get("status") == 304 else "empty",
+                            started_at, t0)
+
+    _progress[epg_url] = {"playlists": len(playlist_ids), "phase": "downloading", "programmes": 0,
+                          "started_at": started_at.isoformat()}
+    try:
+        chunks = _prepend(first, chunks)
+        if known_sha256 or _worker_mode() == "process":
+            # spool and hash first: a 200 with the same bytes as last time never touches the DB
+            # (process workers need the file anyway)
+            h = hashlib.sha256()
+            path = await _spool(chunks, h)
+            try:
+                if known_sha256 and h.hexdigest() == known_sha256:
+                    res = {"staged": 0, "dropped": 0, "inserted": 0, "updated": 0, "deleted": 0,
+                           "sha256": known_sha256, "swapped": False, "changed": False, "same_content": True}
+                elif _worker_mode() == "process":
+                    res = await _run_in_process(epg_url, stage_id, source_id, wanted, path)
+                else:
+                    res = await _run_in_thread(epg_url, stage_id, source_id, wanted, path)
+            finally:
+                os.unlink(path)
+        else:
+            # unconditional refresh: stream straight into staging, parsing overlaps the download
+            res = await _run_in_thread(epg_url, stage_id, source_id, wanted, chunks)
+    finally:
+        _progress.pop(epg_url, None)
 
+    if res["swapped"] or info.get("etag") != source.get("etag") \
+            or info.get("last_modified") != source.get("last_modified"):
+        await asyncio.to_thread(_save_fetch_state, source_id, info.get("etag"), info.get("last_modified"),
+                                res["sha256"], res["changed"], filter_hash if res["swapped"] else None)
+    await _warm_index(source_id, playlist_ids, changed=res["changed"], changed_at=source.get("changed_at"))
+
+    elapsed = time.perf_counter() - t0
+    parsed = res["staged"] + res["dropped"]
+    return {
+        "source_id": source_id,
+        "epg_url": epg_url,
+        "playlist_ids": playlist_ids,
+        "status": "updated" if res["changed"] else ("unchanged" if res["staged"] or res.get("same_content") else "empty"),
+        "programmes_staged": res["staged"],
+        "programmes_dropped": res["dropped"],
+        "programmes_inserted": res["inserted"],
+        "programmes_updated": res["updated"],
+        "programmes_deleted": res["deleted"],
+        "mode": _ingest_mode(),
+        "started_at": started_at.isoformat(),
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(parsed / elapsed, 1) if elapsed > 0 and parsed else None,
+    }
+
+def _attach_source(playlist_id: str, epg_url: str) -> str:
     with db() as conn:
-        for pid in playlist_ids:
-            now_row = conn.execute(
-                text("SELECT title, desc, start_utc, stop_utc FROM epg_programmes "
-                     "WHERE playlist_id=:pid AND tvg_id=:tvg AND start_utc<=:now AND stop_utc>:now "
-                     "ORDER BY start_utc DESC LIMIT 1"),
-                {"pid": pid, "tvg": tvg_id, "now": now},
-            ).mappings().first()
-
-            next_row = conn.execute(
-                text("SELECT title, desc, start_utc, stop_utc FROM epg_programmes "
-                     "WHERE playlist_id=:pid AND tvg_id=:tvg AND start_utc>:now "
-                     "ORDER BY start_utc ASC LIMIT 1"),
-                {"pid": pid, "tvg": tvg_id, "now": now},
-            ).mappings().first()
-
-            if now_row or next_row:
-                def obj(r):
-                    if not r:
-                        return None
-                    return {
-                        "title": r["title"],
-                        "desc": r["desc"],
-                        "start": r["start_utc"].isoformat(),
-                        "stop": r["stop_utc"].isoformat(),
-                    }
-
-                return {"tvg_id": tvg_id, "playlist_id": pid, "now": obj(now_row), "next": obj(next_row)}
+        source_id = ensure_epg_source(conn, epg_url)
+        conn.execute(text("UPDATE playlists SET epg_source_id=:sid WHERE id=:id"), {"sid": source_id, "id": playlist_id})
+    return source_id
+
+async def refresh_epg_for_playlist(playlist_id: str, epg_url: str) -> Dict[str, Any]:
+    # explicit refresh (admin): always re-ingest the playlist's source, for all its current playlists
+    source_id = await asyncio.to_thread(_attach_source, playlist_id, epg_url)
+    groups = await asyncio.to_thread(current_playlists_by_source)
+    group = groups.get(source_id, {"playlist_ids": []})
+    playlist_ids = list(dict.fromkeys([playlist_id, *group["playlist_ids"]]))
+    res = await refresh_epg_source(source_id, playlist_ids, conditional=False)
+    res["playlist_id"] = playlist_id
+    return res
+
+# two probes per (playlist, channel) on the (source_id, tvg_id, start_utc, ...) primary key, through the
+# playlist's source: "now" = latest start <= now still running, "next" = first start > now.
+# Ties on start are broken by stop the same way the in-memory index sorts them.
+_NOW_NEXT_SQL = (
+    "SELECT p.ord, p.pid AS playlist_id, t.tvg AS tvg_id, "
+    "n.title AS now_title, n.description AS now_description, n.start_utc AS now_start_utc, n.stop_utc AS now_stop_utc, "
+    "x.title AS next_title, x.description AS next_description, x.start_utc AS next_start_utc, x.stop_utc AS next_stop_utc "
+    "FROM unnest(CAST(:pids AS TEXT[])) WITH ORDINALITY AS p(pid, ord) "
+    "JOIN playlists pl ON pl.id = p.pid "
+    "CROSS JOIN unnest(CAST(:tvgs AS TEXT[])) AS t(tvg) "
+    "LEFT JOIN LATERAL ("
+    "  SELECT title, description, start_utc, stop_utc FROM epg_programmes "
+    "  WHERE source_id = pl.epg_source_id AND tvg_id = t.tvg AND start_utc >= :lo AND start_utc <= :now AND stop_utc > :now "
+    "  ORDER BY start_utc DESC, stop_utc DESC LIMIT 1"
+    ") n ON TRUE "
+    "LEFT JOIN LATERAL ("
+    "  SELECT title, description, start_utc, stop_utc FROM epg_programmes "
+    "  WHERE source_id = pl.epg_source_id AND tvg_id = t.tvg AND start_utc > :now "
+    "  ORDER BY start_utc, stop_utc LIMIT 1"
+    ") x ON TRUE "
+    "WHERE n.start_utc IS NOT NULL OR x.start_utc IS NOT NULL "
+    "ORDER BY p.ord"
+)
+
+def _max_programme_hours() -> int:
+    return int(os.getenv("EPG_MAX_PROGRAMME_HOURS", "24"))
 
+def _programme_obj(r, prefix: str) -> Optional[Dict[str, Any]]:
+    if r[prefix + "start_utc"] is None:
+        return None
+    return {
+        "title": r[prefix + "title"],
+        "desc": r[prefix + "description"],
+        "start": r[prefix + "start_utc"].isoformat(),
+        "stop": r[prefix + "stop_utc"].isoformat(),
+    }
+
+def _empty_now_next(tvg_id: str) -> Dict[str, Any]:
     return {"tvg_id": tvg_id, "playlist_id": None, "now": None, "next": None}
+
+def _now_next_params(playlist_ids: List[str], tvg_ids: List[str], now: datetime) -> Dict[str, Any]:
+    return {"pids": playlist_ids, "tvgs": tvg_ids, "now": now, "lo": now - timedelta(hours=_max_programme_hours())}
+
+def _now_next_result(rows, tvg_ids: List[str]) -> List[Dict[str, Any]]:
+    found: Dict[str, Dict[str, Any]] = {}
+    for r in rows:
+        if r["tvg_id"] in found:
+            continue  # an earlier playlist already answered for this channel
+        found[r["tvg_id"]] = {"tvg_id": r["tvg_id"], "playlist_id": r["playlist_id"],
+                              "now": _programme_obj(r, "now_"), "next": _programme_obj(r, "next_")}
+    return [found.get(t) or _empty_now_next(t) for t in tvg_ids]
+
+def now_next_batch(playlist_ids: List[str], tvg_ids: List[str]) -> List[Dict[str, Any]]:
+    """
+    Now/next for many channels in one query. For each tvg_id the first playlist
+    (in playlist_ids order) that has guide data wins, as in now_next_for_playlists.
+    """
+    tvg_ids = list(dict.fromkeys(tvg_ids))
+    if not playlist_ids or not tvg_ids:
+        return [_empty_now_next(t) for t in tvg_ids]
+
+    now = datetime.now(timezone.utc)
+    cached = epg_index.now_next(playlist_ids, tvg_ids, now)
+    if cached is not None:
+        return cached
+
+    with db() as conn:
+        rows = conn.execute(text(_NOW_NEXT_SQL), _now_next_params(playlist_ids, tvg_ids, now)).mappings().all()
+    return _now_next_result(rows, tvg_ids)
+
+async def now_next_batch_async(playlist_ids: List[str], tvg_ids: List[str]) -> List[Dict[str, Any]]:
+    """now_next_batch on the async engine; a warm in-memory index answers without any I/O."""
+    tvg_ids = list(dict.fromkeys(tvg_ids))
+    if not playlist_ids or not tvg_ids:
+        return [_empty_now_next(t) for t in tvg_ids]
+
+    now = datetime.now(timezone.utc)
+    cached = epg_index.now_next(playlist_ids, tvg_ids, now)
+    if cached is not None:
+        return cached
+
+    async with adb() as conn:
+        rows = (await conn.execute(text(_NOW_NEXT_SQL), _now_next_params(playlist_ids, tvg_ids, now))).mappings().all()
+    return _now_next_result(rows, tvg_ids)
+
+def now_next_for_playlists(playlist_ids: List[str], tvg_id: str) -> Dict[str, Any]:
+    return now_next_batch(playlist_ids, [tvg_id])[0]
+
+async def now_next_for_playlists_async(playlist_ids: List[str], tvg_id: str) -> Dict[str, Any]:
+    return (await now_next_batch_async(playlist_ids, [tvg_id]))[0]
+
+# programmes overlapping [lo, hi) for the given channels; served by epg_programmes_grid_idx
+_GRID_SQL = (
+    "SELECT p.ord, p.pid AS playlist_id, e.tvg_id, e.title, e.description, e.start_utc, e.stop_utc "
+    "FROM unnest(CAST(:pids AS TEXT[])) WITH ORDINALITY AS p(pid, ord) "
+    "JOIN playlists pl ON pl.id = p.pid "
+    "JOIN epg_programmes e ON e.source_id = pl.epg_source_id "
+    "WHERE e.tvg_id = ANY(:tvgs) AND tstzrange(e.start_utc, e.stop_utc) && tstzrange(:lo, :hi) "
+    'ORDER BY e.tvg_id COLLATE "C", p.ord, e.start_utc'
+)
+# channels per grid query; one page is fetched and its transaction closed before anything is yielded
+_GRID_PAGE_CHANNELS = 50
+
+def iter_grid(playlist_ids: List[str], tvg_ids: List[str], lo: datetime, hi: datetime) -> Iterator[Dict[str, Any]]:
+    """
+    Stream programmes overlapping [lo, hi), ordered by channel then start, one
+    page of channels at a time. No transaction stays open while a slow client
+    drains the response (idle_in_transaction_session_timeout would cut it).
+    Per channel only the first playlist (in playlist_ids order) with data is used,
+    as in now_next_batch.
+    """
+    if not playlist_ids or not tvg_ids:
+        return
+    # code-point order, same as the COLLATE "C" sort inside each page
+    tvgs = sorted(set(tvg_ids))
+    for i in range(0, len(tvgs), _GRID_PAGE_CHANNELS):
+        with db() as conn:
+            rows = conn.execute(
+                text(_GRID_SQL), {"pids": playlist_ids, "tvgs": tvgs[i:i + _GRID_PAGE_CHANNELS], "lo": lo, "hi": hi},
+            ).mappings().all()
+        cur_tvg, cur_ord = None, None
+        for r in rows:
+            if r["tvg_id"] != cur_tvg:
+                cur_tvg, cur_ord = r["tvg_id"], r["ord"]
+            elif r["ord"] != cur_ord:
+                continue
+            yield {
+                "tvg_id": r["tvg_id"],
+                "playlist_id": r["playlist_id"],
+                "title": r["title"],
+                "desc": r["description"],
+                "start": r["start_utc"].isoformat(),
+                "stop": r["stop_utc"].isoformat(),
+            }
@@ -0,0 +1,92 @@
+"""
+EPG sources: one row per distinct guide URL (normalized), shared by every
+playlist that points at it. epg_programmes is keyed by source_id, so a guide is
+downloaded and stored once no matter how many playlists / re-uploads use it.
+The row also carries the conditional-fetch state (etag, last_modified, content hash).
+"""
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from app.db import db
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_epg_url(url: str) -> str:
+    """Case-insensitive scheme/host, no default port, no fragment; path and query are kept as is."""
+    url = (url or "").strip()
+    parts = urlsplit(url)
+    if not parts.scheme or not parts.netloc:
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != _DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    if parts.username:
+        auth = parts.username + (f":{parts.password}" if parts.password else "")
+        host = f"{auth}@{host}"
+    return urlunsplit((scheme, host, parts.path or "/", parts.query, ""))
+
+
+def ensure_epg_source(conn: Connection, url: str) -> str:
+    """Source id for the URL, created on first use."""
+    norm = normalize_epg_url(url)
+    conn.execute(
+        text("INSERT INTO epg_sources(id, url, created_at) VALUES(:id,:u,:ca) ON CONFLICT (url) DO NOTHING"),
+        {"id": f"src_{uuid.uuid4().hex[:10]}", "u": norm, "ca": datetime.now(timezone.utc)},
+    )
+    return conn.execute(text("SELECT id FROM epg_sources WHERE url=:u"), {"u": norm}).scalar_one()
+
+
+def backfill_playlist_sources(conn: Connection) -> None:
+    """Migration step: attach existing playlists to their source."""
+    rows = conn.execute(
+        text("SELECT id, epg_url FROM playlists WHERE epg_url IS NOT NULL AND epg_url<>'' AND epg_source_id IS NULL")
+    ).mappings().all()
+    for r in rows:
+        conn.execute(
+            text("UPDATE playlists SET epg_source_id=:sid WHERE id=:id"),
+            {"sid": ensure_epg_source(conn, r["epg_url"]), "id": r["id"]},
+        )
+
+
+def carry_fetch_state(conn: Connection) -> None:
+    """Migration step: move the per-URL conditional-fetch state (epg_fetch_state) onto the matching source."""
+    rows = conn.execute(
+        text("SELECT url, etag, last_modified, content_sha256, changed_at FROM epg_fetch_state")
+    ).mappings().all()
+    for r in rows:
+        conn.execute(
+            text("UPDATE epg_sources SET etag=:etag, last_modified=:lm, content_sha256=:sha, changed_at=:ca "
+                 "WHERE url=:u AND etag IS NULL AND last_modified IS NULL AND content_sha256 IS NULL"),
+            {"u": normalize_epg_url(r["url"]), "etag": r["etag"], "lm": r["last_modified"],
+             "sha": r["content_sha256"], "ca": r["changed_at"]},
+        )
+
+
+def get_epg_source(source_id: str) -> Optional[dict]:
+    with db() as conn:
+        row = conn.execute(
+            text("SELECT id, url, etag, last_modified, content_sha256, filter_hash, changed_at FROM epg_sources WHERE id=:id"),
+            {"id": source_id},
+        ).mappings().first()
+        return dict(row) if row else None
+
+
+def current_playlists_by_source() -> Dict[str, dict]:
+    """source_id -> {url, playlist_ids} for current playlists (one per package); replaced playlists are ignored."""
+    with db() as conn:
+        rows = conn.execute(text(
+            "SELECT s.id, s.url, p.id AS playlist_id FROM epg_sources s "
+            "JOIN playlists p ON p.epg_source_id = s.id "
+            "JOIN package_current_playlist c ON c.playlist_id = p.id"
+        )).mappings().all()
+    groups: Dict[str, dict] = {}
+    for r in rows:
+        groups.setdefault(r["id"], {"url": r["url"], "playlist_ids": []})["playlist_ids"].append(r["playlist_id"])
+    return groups
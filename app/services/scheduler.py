@@ -1,25 +1,88 @@
-import os, asyncio
-from sqlalchemy import text
-from app.db import db, init_db
-from app.services.epg_service import refresh_epg_for_playlist
+import os, asyncio, time
+from datetime import datetime, timezone
+from typing import Dict, Any, List
+
+from app.services import epg_index
+from app.services.epg_retention import prune_epg, prune_orphan_programmes
+from app.services.epg_service import refresh_epg_source
+from app.services.epg_sources import current_playlists_by_source
+
+# per-source stats for /api/admin/epg/sources
+_source_stats: Dict[str, Dict[str, Any]] = {}
+
+
+def epg_source_stats() -> Dict[str, Dict[str, Any]]:
+    return {k: dict(v) for k, v in _source_stats.items()}
+
+
+def _record(url: str, playlist_ids: List[str], status: str, seconds: float, error: str | None = None) -> None:
+    st = _source_stats.setdefault(url, {"runs": 0, "updated": 0, "skipped": 0, "errors": 0})
+    st["runs"] += 1
+    if status == "updated":
+        st["updated"] += 1
+    elif status == "error":
+        st["errors"] += 1
+    else:
+        st["skipped"] += 1
+    st["playlists"] = len(playlist_ids)
+    st["last_status"] = status
+    st["last_seconds"] = round(seconds, 3)
+    st["last_error"] = error
+    st["last_run_at"] = datetime.now(timezone.utc).isoformat()
+
+
+async def refresh_all_epg_sources() -> Dict[str, Any]:
+    """One download per EPG source (shared by its playlists), at most EPG_CONCURRENCY at a time."""
+    groups = await asyncio.to_thread(current_playlists_by_source)
+    sem = asyncio.Semaphore(max(1, int(os.getenv("EPG_CONCURRENCY", "2"))))
+
+    async def one(source_id: str, url: str, playlist_ids: List[str]) -> str:
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                res = await refresh_epg_source(source_id, playlist_ids)
+                _record(url, playlist_ids, res["status"], time.perf_counter() - t0)
+                return res["status"]
+            except Exception as e:
+                _record(url, playlist_ids, "error", time.perf_counter() - t0, str(e))
+                return "error"
+
+    statuses = await asyncio.gather(*(one(sid, g["url"], g["playlist_ids"]) for sid, g in groups.items()))
+    # replaced / deleted playlists: free their now/next index
+    epg_index.retain({sid: g["playlist_ids"] for sid, g in groups.items()})
+    return {"sources": len(groups), "updated": statuses.count("updated"),
+            "errors": statuses.count("error"), "skipped": len(statuses) - statuses.count("updated") - statuses.count("error")}
+
+
+async def _sync_epg_index() -> None:
+    # picks up guides / playlist sources changed by other workers between refreshes
+    seconds = float(os.getenv("EPG_INDEX_SYNC_SECONDS", "60"))
+    while True:
+        await asyncio.sleep(seconds)
+        try:
+            stale = await asyncio.to_thread(epg_index.sync_with_db)
+            for source_id, playlist_ids in stale.items():
+                await asyncio.to_thread(epg_index.rebuild, source_id, playlist_ids)
+        except Exception:
+            pass
+
 
 async def start_scheduler():
-    init_db()
     hours = int(os.getenv("EPG_REFRESH_HOURS", "6"))
     await asyncio.sleep(2)
+    asyncio.create_task(_sync_epg_index())
 
     while True:
         try:
-            with db() as conn:
-                rows = conn.execute(
-                    text("SELECT id, epg_url FROM playlists WHERE epg_url IS NOT NULL AND epg_url<>''")
-                ).mappings().all()
-
-            for r in rows:
-                try:
-                    await refresh_epg_for_playlist(r["id"], r["epg_url"])
-                except Exception:
-                    pass
+            await asyncio.to_thread(prune_epg)
+        except Exception:
+            pass
+        try:
+            await asyncio.to_thread(prune_orphan_programmes)
+        except Exception:
+            pass
+        try:
+            await refresh_all_epg_sources()
         except Exception:
             pass
 
@@ -0,0 +1,24 @@
+import re
+import unicodedata
+from typing import Optional
+
+# Cyrillic -> Latin folding, so "Первый", "pervyi" and "PERVYI" land on the same key.
+# Applied after NFKD + combining-mark removal (ё -> е, й -> и, ї -> і).
+_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "ґ": "g", "д": "d", "е": "e", "є": "e",
+    "ж": "zh", "з": "z", "и": "i", "і": "i", "к": "k", "л": "l", "м": "m", "н": "n",
+    "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "h",
+    "ц": "c", "ч": "ch", "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "ь": "", "э": "e",
+    "ю": "yu", "я": "ya",
+})
+# anything but letters/digits of any script; scripts without a transliteration are kept as is
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+
+def normalize_search(*parts: Optional[str]) -> str:
+    """Casefold (ß -> ss), strip accents, transliterate Cyrillic, collapse punctuation to single spaces."""
+    s = " ".join(p for p in parts if p).casefold()
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = s.translate(_TRANSLIT)
+    return _NON_WORD_RE.sub(" ", s).strip()
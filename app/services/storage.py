@@ -1,11 +1,20 @@
+import base64
+import hashlib
+import json
+import os
 import uuid
 from datetime import datetime, timezone, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 
 from sqlalchemy import text
 
-from app.db import db
-from app.parsers.m3u import parse_m3u, extract_epg_url
+from app.db import adb, db, copy_rows, on_commit, without_timeouts
+from app.cache import entitlement_cache
+from app.parsers.m3u import iter_m3u, epg_url_from_header
+from app.services.search import normalize_search
+from app.services.catalog import build_catalog_snapshot
+from app.services.epg_sources import ensure_epg_source
+from app.services import epg_index
 
 
 # ---------- Packages ----------
@@ -25,6 +34,12 @@ def list_packages() -> List[dict]:
         rows = conn.execute(text("SELECT id, name, price_cents, currency, stripe_price_id, created_at FROM packages ORDER BY price_cents ASC")).mappings().all()
         return [dict(r) for r in rows]
 
+def packages_version() -> str:
+    # cheap catalog revision for ETags: the packages table is append-only
+    with db() as conn:
+        r = conn.execute(text("SELECT COUNT(*) AS c, MAX(created_at) AS m FROM packages")).mappings().first()
+        return f"{r['c']}:{r['m'].isoformat() if r['m'] else ''}"
+
 def get_package(package_id: str) -> Optional[dict]:
     with db() as conn:
         r = conn.execute(text("SELECT * FROM packages WHERE id=:id"), {"id": package_id}).mappings().first()
@@ -95,6 +110,7 @@ def set_user_stripe(customer_id: str, subscription_id: str, email: Optional[str]
 def set_user_current_package(user_id: str, package_id: str) -> None:
     with db() as conn:
         conn.execute(text("UPDATE users SET current_package_id=:p WHERE id=:id"), {"p": package_id, "id": user_id})
+    on_commit(lambda: entitlement_cache.invalidate(user_id))
 
 
 def update_subscription_state(user_id: str, status: str, paid_until: Optional[datetime]) -> None:
@@ -103,6 +119,7 @@ def update_subscription_state(user_id: str, status: str, paid_until: Optional[da
             text("UPDATE users SET status=:st, paid_until=:pu WHERE id=:id"),
             {"st": status, "pu": paid_until, "id": user_id},
         )
+    on_commit(lambda: entitlement_cache.invalidate(user_id))
 
 def is_subscription_active(user: dict) -> bool:
     if not user:
@@ -180,28 +197,111 @@ def register_device(user_id: str, device_id: str) -> Dict[str, Any]:
 
 
 # ---------- Playlists / Channels ----------
+_CHANNEL_COLUMNS = ("playlist_id", "tvg_id", "name", "tvg_name", "logo", "grp", "stream_url", "raw_extinf", "search_text")
+# fields compared when diffing a re-upload against the stored channels
+_CHANNEL_FIELDS = ("name", "tvg_name", "logo", "grp", "stream_url", "raw_extinf")
+
+def playlist_hash(m3u_text: str) -> str:
+    return hashlib.sha256(m3u_text.encode("utf-8")).hexdigest()
+
+def _channel_row(playlist_id: str, ch) -> tuple:
+    return (playlist_id, ch.tvg_id, ch.name, ch.tvg_name, ch.logo, ch.grp, ch.stream_url, ch.raw_extinf,
+            normalize_search(ch.name, ch.tvg_name, ch.tvg_id))
+
+def _apply_channel_delta(conn, playlist_id: str, channels: Dict[str, Any]) -> Dict[str, int]:
+    """Bring the stored channels of the playlist in line with `channels` (tvg_id -> Channel) with bulk statements."""
+    rows = conn.execute(
+        text("SELECT tvg_id, name, tvg_name, logo, grp, stream_url, raw_extinf FROM channels WHERE playlist_id=:pid"),
+        {"pid": playlist_id},
+    ).all()
+    old = {r[0]: tuple(r[1:]) for r in rows}
+    deleted = [t for t in old if t not in channels]
+    added = [ch for t, ch in channels.items() if t not in old]
+    changed = [ch for t, ch in channels.items()
+               if t in old and old[t] != tuple(getattr(ch, f) for f in _CHANNEL_FIELDS)]
+    if deleted:
+        conn.execute(text("DELETE FROM channels WHERE playlist_id=:pid AND tvg_id = ANY(:tvgs)"),
+                     {"pid": playlist_id, "tvgs": deleted})
+    if changed:
+        conn.execute(
+            text("UPDATE channels SET name=:name, tvg_name=:tvg_name, logo=:logo, grp=:grp, stream_url=:stream_url, "
+                 "raw_extinf=:raw_extinf, search_text=:search_text WHERE playlist_id=:playlist_id AND tvg_id=:tvg_id"),
+            [dict(zip(_CHANNEL_COLUMNS, _channel_row(playlist_id, ch))) for ch in changed],
+        )
+    copy_rows(conn, "channels", _CHANNEL_COLUMNS, (_channel_row(playlist_id, ch) for ch in added))
+    return {"inserted": len(added), "updated": len(changed), "deleted": len(deleted)}
+
 def save_playlist_for_package(m3u_text: str, package_id: str, source_type: str, source_value: str) -> Dict[str, Any]:
-    playlist_id = f"pl_{uuid.uuid4().hex[:10]}"
-    created_at = datetime.now(timezone.utc)
-    epg_url = extract_epg_url(m3u_text)
-    channels = parse_m3u(m3u_text)
+    """
+    Store an uploaded playlist as the package's current one.
+    Same content as the current playlist: no-op. Changed content: the current
+    playlist is updated in place (channel delta, version bump). First upload: new playlist.
+    """
+    now = datetime.now(timezone.utc)
+    content_hash = playlist_hash(m3u_text)
 
     with db() as conn:
-        conn.execute(
-            text("INSERT INTO playlists(id, package_id, source_type, source_value, m3u_text, epg_url, created_at) "
-                 "VALUES(:id,:pkg,:st,:sv,:m3u,:epg,:ca)"),
-            {"id": playlist_id, "pkg": package_id, "st": source_type, "sv": source_value, "m3u": m3u_text, "epg": epg_url, "ca": created_at},
-        )
-        for ch in channels:
+        without_timeouts(conn)
+        cur = conn.execute(
+            text("SELECT p.id, p.version, p.content_hash, p.epg_url, p.epg_source_id FROM package_current_playlist c "
+                 "JOIN playlists p ON p.id = c.playlist_id WHERE c.package_id=:pkg FOR UPDATE OF p"),
+            {"pkg": package_id},
+        ).mappings().first()
+        if cur and cur["content_hash"] == content_hash:
+            count = conn.execute(text("SELECT COUNT(*) FROM channels WHERE playlist_id=:pid"), {"pid": cur["id"]}).scalar_one()
+            return {"playlist_id": cur["id"], "package_id": package_id, "epg_url": cur["epg_url"],
+                    "channels_count": count, "version": cur["version"], "unchanged": True,
+                    "delta": {"inserted": 0, "updated": 0, "deleted": 0}}
+
+        # one pass for channels and the #EXTM3U header; last-wins dedup by tvg_id
+        header: Dict[str, str] = {}
+        channels = {c.tvg_id: c for c in iter_m3u(m3u_text, header=header)}
+        epg_url = epg_url_from_header(header)
+        # playlists with the same url-tvg share one stored guide
+        source_id = ensure_epg_source(conn, epg_url) if epg_url else None
+        if cur:
+            playlist_id, version = cur["id"], cur["version"] + 1
+            conn.execute(
+                text("UPDATE playlists SET source_type=:st, source_value=:sv, m3u_text=:m3u, epg_url=:epg, "
+                     "epg_source_id=:src, content_hash=:h, version=:v WHERE id=:id"),
+                {"id": playlist_id, "st": source_type, "sv": source_value, "m3u": m3u_text, "epg": epg_url,
+                 "src": source_id, "h": content_hash, "v": version},
+            )
+        else:
+            playlist_id, version = f"pl_{uuid.uuid4().hex[:10]}", 1
             conn.execute(
-                text("INSERT INTO channels(playlist_id, tvg_id, name, tvg_name, logo, grp, stream_url, raw_extinf) "
-                     "VALUES(:pid,:tvg,:name,:tvg_name,:logo,:grp,:url,:raw) "
-                     "ON CONFLICT (playlist_id, tvg_id) DO UPDATE SET "
-                     "name=EXCLUDED.name, tvg_name=EXCLUDED.tvg_name, logo=EXCLUDED.logo, grp=EXCLUDED.grp, stream_url=EXCLUDED.stream_url, raw_extinf=EXCLUDED.raw_extinf"),
-                {"pid": playlist_id, "tvg": ch.tvg_id, "name": ch.name, "tvg_name": ch.tvg_name, "logo": ch.logo, "grp": ch.grp, "url": ch.stream_url, "raw": ch.raw_extinf},
+                text("INSERT INTO playlists(id, package_id, source_type, source_value, m3u_text, epg_url, epg_source_id, "
+                     "content_hash, version, created_at) VALUES(:id,:pkg,:st,:sv,:m3u,:epg,:src,:h,:v,:ca)"),
+                {"id": playlist_id, "pkg": package_id, "st": source_type, "sv": source_value, "m3u": m3u_text,
+                 "epg": epg_url, "src": source_id, "h": content_hash, "v": version, "ca": now},
             )
+        delta = _apply_channel_delta(conn, playlist_id, channels)
+        conn.execute(
+            text("INSERT INTO package_current_playlist(package_id, playlist_id, updated_at) VALUES(:pkg,:pid,:ca) "
+                 "ON CONFLICT (package_id) DO UPDATE SET playlist_id=EXCLUDED.playlist_id, updated_at=EXCLUDED.updated_at"),
+            {"pkg": package_id, "pid": playlist_id, "ca": now},
+        )
 
-    return {"playlist_id": playlist_id, "package_id": package_id, "epg_url": epg_url, "channels_count": len(channels)}
+    build_catalog_snapshot(playlist_id, version, (
+        {"playlist_id": playlist_id, "tvg_id": ch.tvg_id, "name": ch.name, "tvg_name": ch.tvg_name,
+         "logo": ch.logo, "grp": ch.grp, "stream_url": ch.stream_url}
+        for ch in channels.values()
+    ))
+    # subscribers' cached playlist versions (catalog ETags) are stale now
+    on_commit(entitlement_cache.clear)
+    if cur and source_id != cur["epg_source_id"]:
+        # now/next index must not keep answering from the old guide
+        on_commit(lambda: epg_index.forget_playlist(playlist_id))
+    return {"playlist_id": playlist_id, "package_id": package_id, "epg_url": epg_url, "channels_count": len(channels),
+            "version": version, "unchanged": False, "delta": delta}
+
+def get_playlist(playlist_id: str) -> Optional[dict]:
+    with db() as conn:
+        row = conn.execute(
+            text("SELECT id, package_id, source_type, source_value, epg_url, created_at FROM playlists WHERE id=:id"),
+            {"id": playlist_id},
+        ).mappings().first()
+        return dict(row) if row else None
 
 def get_latest_playlist_for_package(package_id: str) -> Optional[dict]:
     with db() as conn:
@@ -211,51 +311,180 @@ def get_latest_playlist_for_package(package_id: str) -> Optional[dict]:
         ).mappings().first()
         return dict(row) if row else None
 
+# latest playlist per active package, without the m3u_text blob
+_ACTIVE_PLAYLISTS_POINTER_SQL = (
+    "SELECT p.id, p.package_id, p.epg_url, p.version, p.created_at "
+    "FROM user_packages up "
+    "JOIN package_current_playlist cp ON cp.package_id = up.package_id "
+    "JOIN playlists p ON p.id = cp.playlist_id "
+    "WHERE up.user_id=:u AND (up.active_until IS NULL OR up.active_until > :now) "
+    "ORDER BY p.created_at DESC"
+)
+_ACTIVE_PLAYLISTS_SQL = (
+    "SELECT DISTINCT ON (p.package_id) p.id, p.package_id, p.epg_url, p.version, p.created_at "
+    "FROM user_packages up "
+    "JOIN playlists p ON p.package_id = up.package_id "
+    "WHERE up.user_id=:u AND (up.active_until IS NULL OR up.active_until > :now) "
+    "ORDER BY p.package_id, p.created_at DESC"
+)
+
+def _use_playlist_pointer() -> bool:
+    return os.getenv("PLAYLIST_POINTER", "1").strip().lower() not in ("0", "false", "no")
+
+def _active_playlists_query(user_id: str) -> Tuple[str, Dict[str, Any]]:
+    sql = _ACTIVE_PLAYLISTS_POINTER_SQL if _use_playlist_pointer() else _ACTIVE_PLAYLISTS_SQL
+    return sql, {"u": user_id, "now": datetime.now(timezone.utc)}
+
 def get_active_playlists_for_user(user_id: str) -> List[dict]:
-    now = datetime.now(timezone.utc)
+    sql, params = _active_playlists_query(user_id)
     with db() as conn:
-        pkgs = conn.execute(
-            text("SELECT package_id, active_until FROM user_packages WHERE user_id=:u AND (active_until IS NULL OR active_until > :now)"),
-            {"u": user_id, "now": now},
-        ).mappings().all()
+        rows = conn.execute(text(sql), params).mappings().all()
+        return [dict(r) for r in rows]
+
+async def get_active_playlists_for_user_async(user_id: str) -> List[dict]:
+    sql, params = _active_playlists_query(user_id)
+    async with adb() as conn:
+        rows = (await conn.execute(text(sql), params)).mappings().all()
+        return [dict(r) for r in rows]
 
-        playlists = []
-        for r in pkgs:
-            pl = conn.execute(
-                text("SELECT * FROM playlists WHERE package_id=:pkg ORDER BY created_at DESC LIMIT 1"),
-                {"pkg": r["package_id"]},
-            ).mappings().first()
-            if pl:
-                playlists.append(dict(pl))
-        return playlists
+_GROUPS_SQL = "SELECT DISTINCT grp FROM channels WHERE playlist_id = ANY(:ids) AND grp IS NOT NULL AND grp<>'' ORDER BY grp"
 
 def list_groups_for_playlists(playlist_ids: List[str]) -> List[str]:
     if not playlist_ids:
         return []
     with db() as conn:
-        rows = conn.execute(
-            text("SELECT DISTINCT grp FROM channels WHERE playlist_id = ANY(:ids) AND grp IS NOT NULL AND grp<>'' ORDER BY grp"),
-            {"ids": playlist_ids},
-        ).mappings().all()
-        return [r["grp"] for r in rows]
+        return list(conn.execute(text(_GROUPS_SQL), {"ids": playlist_ids}).scalars().all())
 
-def list_channels_for_playlists(playlist_ids: List[str], group: Optional[str]=None, search: Optional[str]=None, limit: int=5000) -> List[dict]:
+async def list_groups_for_playlists_async(playlist_ids: List[str]) -> List[str]:
+    if not playlist_ids:
+        return []
+    async with adb() as conn:
+        return list((await conn.execute(text(_GROUPS_SQL), {"ids": playlist_ids})).scalars().all())
+
+def list_tvg_ids_for_group(playlist_ids: List[str], group: str) -> List[str]:
     if not playlist_ids:
         return []
-    params = {"ids": playlist_ids, "limit": limit}
+    with db() as conn:
+        rows = conn.execute(
+            text("SELECT DISTINCT tvg_id FROM channels WHERE playlist_id = ANY(:ids) AND grp=:g"),
+            {"ids": playlist_ids, "g": group},
+        ).scalars().all()
+        return list(rows)
+
+def _channels_query(playlist_ids: List[str], group: Optional[str], search: Optional[str],
+                    limit: int) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """(sql, params), or None for a search that normalizes to nothing (it can't match anything)."""
+    params: Dict[str, Any] = {"ids": playlist_ids, "limit": limit}
     sql = "SELECT playlist_id, tvg_id, name, tvg_name, logo, grp, stream_url FROM channels WHERE playlist_id = ANY(:ids)"
     if group:
         sql += " AND grp=:grp"
         params["grp"] = group
-    if search:
-        sql += " AND (name ILIKE :s OR tvg_id ILIKE :s OR COALESCE(tvg_name,'') ILIKE :s)"
-        params["s"] = f"%{search}%"
-    sql += " ORDER BY grp, name LIMIT :limit"
+    q = normalize_search(search) if search else ""
+    if search and not q:
+        return None
+    if q:
+        # trigram GIN index on search_text; word-prefix hits first, then by similarity
+        sql += " AND search_text LIKE :like"
+        params.update({"q": q, "like": f"%{q}%", "word": f"% {q}%"})
+        sql += " ORDER BY (' ' || search_text) LIKE :word DESC, similarity(search_text, :q) DESC, name LIMIT :limit"
+    else:
+        sql += " ORDER BY grp, name LIMIT :limit"
+    return sql, params
 
+def list_channels_for_playlists(playlist_ids: List[str], group: Optional[str]=None, search: Optional[str]=None, limit: int=5000) -> List[dict]:
+    query = _channels_query(playlist_ids, group, search, limit) if playlist_ids else None
+    if query is None:
+        return []
+    sql, params = query
     with db() as conn:
         rows = conn.execute(text(sql), params).mappings().all()
         return [dict(r) for r in rows]
 
+async def list_channels_for_playlists_async(playlist_ids: List[str], group: Optional[str] = None,
+                                            search: Optional[str] = None, limit: int = 5000) -> List[dict]:
+    query = _channels_query(playlist_ids, group, search, limit) if playlist_ids else None
+    if query is None:
+        return []
+    sql, params = query
+    async with adb() as conn:
+        rows = (await conn.execute(text(sql), params)).mappings().all()
+        return [dict(r) for r in rows]
+
+
+# keyset order for channel pages: (COALESCE(grp,''), name, playlist_id, tvg_id)
+def _encode_cursor(row: dict) -> str:
+    raw = json.dumps([row["grp"] or "", row["name"], row["playlist_id"], row["tvg_id"]], ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str) -> Tuple[str, str, str, str]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+        if isinstance(key, list) and len(key) == 4 and all(isinstance(k, str) for k in key):
+            return key[0], key[1], key[2], key[3]
+    except Exception:
+        pass
+    raise ValueError("invalid cursor")
+
+def _channels_page_query(playlist_ids: List[str], group: Optional[str], cursor: Optional[str],
+                         limit: int) -> Tuple[str, Dict[str, Any]]:
+    params: Dict[str, Any] = {"lim": limit + 1}
+    after = _decode_cursor(cursor) if cursor else None
+    if after:
+        params.update({"cg": after[0], "cn": after[1], "ct": after[3]})
+    if group:
+        params["grp"] = group
+
+    parts = []
+    for i, pid in enumerate(playlist_ids):
+        params[f"p{i}"] = pid
+        where = f"playlist_id=:p{i}"
+        if group:
+            where += " AND grp=:grp"
+        if after:
+            # (g, name, pid, tvg) > cursor, rewritten per playlist so it stays an index range
+            if pid > after[2]:
+                where += " AND (COALESCE(grp,''), name) >= (:cg, :cn)"
+            elif pid < after[2]:
+                where += " AND (COALESCE(grp,''), name) > (:cg, :cn)"
+            else:
+                where += " AND (COALESCE(grp,''), name, tvg_id) > (:cg, :cn, :ct)"
+        parts.append(
+            "(SELECT playlist_id, tvg_id, name, tvg_name, logo, grp, stream_url, COALESCE(grp,'') AS sort_grp "
+            f"FROM channels WHERE {where} ORDER BY COALESCE(grp,''), name, tvg_id LIMIT :lim)"
+        )
+    sql = " UNION ALL ".join(parts) + " ORDER BY sort_grp, name, playlist_id, tvg_id LIMIT :lim"
+    return sql, params
+
+def _channels_page_result(rows, limit: int) -> Tuple[List[dict], Optional[str]]:
+    items = [{k: v for k, v in r.items() if k != "sort_grp"} for r in rows[:limit]]
+    next_cursor = _encode_cursor(items[-1]) if len(rows) > limit else None
+    return items, next_cursor
+
+def list_channels_page(playlist_ids: List[str], group: Optional[str] = None, cursor: Optional[str] = None,
+                       limit: int = 200) -> Tuple[List[dict], Optional[str]]:
+    """
+    One keyset page of channels plus the cursor for the next page (None at the end).
+    Each playlist is probed separately on channels_page_idx and the partial pages merged,
+    so the work per page is O(limit * playlists) whatever the position.
+    Raises ValueError on a malformed cursor.
+    """
+    if not playlist_ids:
+        return [], None
+    sql, params = _channels_page_query(playlist_ids, group, cursor, limit)
+    with db() as conn:
+        rows = conn.execute(text(sql), params).mappings().all()
+    return _channels_page_result(rows, limit)
+
+async def list_channels_page_async(playlist_ids: List[str], group: Optional[str] = None, cursor: Optional[str] = None,
+                                   limit: int = 200) -> Tuple[List[dict], Optional[str]]:
+    """list_channels_page on the async engine."""
+    if not playlist_ids:
+        return [], None
+    sql, params = _channels_page_query(playlist_ids, group, cursor, limit)
+    async with adb() as conn:
+        rows = (await conn.execute(text(sql), params)).mappings().all()
+    return _channels_page_result(rows, limit)
+
 
 # ---------- User packages assignment (used by admin & also for active playlists) ----------
 def assign_package_to_user(user_id: str, package_id: str, active_until: Optional[datetime] = None) -> Dict[str, Any]:
@@ -265,6 +494,7 @@ def assign_package_to_user(user_id: str, package_id: str, active_until: Optional
                  "ON CONFLICT (user_id, package_id) DO UPDATE SET active_until=EXCLUDED.active_until"),
             {"u": user_id, "p": package_id, "au": active_until},
         )
+    on_commit(lambda: entitlement_cache.invalidate(user_id))
     return {"user_id": user_id, "package_id": package_id, "active_until": active_until.isoformat() if active_until else None}
 
 def create_user(note: str = "", device_limit: int = 2) -> Dict[str, Any]:
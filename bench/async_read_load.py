@@ -0,0 +1,72 @@
+"""
+Throughput of the user read endpoints at rising concurrency.
+
+    python bench/async_read_load.py --base http://localhost:8000 --token $TOKEN \
+        --concurrency 8 32 128 256 --seconds 20
+
+Runs --concurrency closed-loop clients against /api/me/groups, /api/me/channels
+and /api/me/epg/now_next/{tvg} in turn and prints req/s and latency per level.
+Run it against the previous build (sync handlers, one threadpool thread per
+request, capped at 40 by default) and this one (async handlers on adb()); the
+sync build flattens out at the threadpool size, the async one at the DB pool.
+Start the server with ENTITLEMENT_CACHE_TTL=0 to put the auth query on every
+request too.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import aiohttp
+
+
+async def _client(session: aiohttp.ClientSession, url: str, headers: dict, stop_at: float,
+                  samples: list, errors: list) -> None:
+    while time.perf_counter() < stop_at:
+        t0 = time.perf_counter()
+        async with session.get(url, headers=headers) as resp:
+            await resp.read()
+            if resp.status != 200:
+                errors.append(resp.status)
+                continue
+        samples.append((time.perf_counter() - t0) * 1000.0)
+
+
+async def _level(session: aiohttp.ClientSession, url: str, headers: dict, seconds: float, concurrency: int) -> None:
+    samples: list = []
+    errors: list = []
+    stop_at = time.perf_counter() + seconds
+    await asyncio.gather(*(_client(session, url, headers, stop_at, samples, errors) for _ in range(concurrency)))
+    if not samples:
+        print(f"{concurrency:>6}: no successful requests ({len(errors)} errors)")
+        return
+    q = statistics.quantiles(samples, n=100)
+    print(f"{concurrency:>6}: {len(samples) / seconds:8.0f} req/s  p50={q[49]:7.1f}ms  p99={q[98]:7.1f}ms"
+          f"  errors={len(errors)}")
+
+
+async def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base", default="http://localhost:8000")
+    ap.add_argument("--token", required=True, help="bearer token of a user with an active package")
+    ap.add_argument("--tvg-id", default="", help="channel for now/next (skipped if empty)")
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[8, 32, 128, 256])
+    ap.add_argument("--seconds", type=float, default=20.0)
+    args = ap.parse_args()
+
+    base = args.base.rstrip("/")
+    paths = ["/api/me/groups", "/api/me/channels?limit=200"]
+    if args.tvg_id:
+        paths.append(f"/api/me/epg/now_next/{args.tvg_id}")
+    headers = {"Authorization": f"Bearer {args.token}"}
+    connector = aiohttp.TCPConnector(limit=0)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        for path in paths:
+            print(path)
+            for c in args.concurrency:
+                await _level(session, base + path, headers, args.seconds, c)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
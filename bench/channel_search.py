@@ -0,0 +1,84 @@
+"""
+Channel search: legacy ILIKE scan vs normalized search_text + trigram index.
+
+    DATABASE_URL=postgresql://... python bench/channel_search.py --sizes 10000 50000 100000
+
+Loads synthetic channels into throwaway playlists (removed afterwards), then
+times both queries for a few typical search-box inputs. Needs migrations applied.
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import text  # noqa: E402
+
+from app.db import db, copy_rows  # noqa: E402
+from app.services.search import normalize_search  # noqa: E402
+
+_WORDS = ["Первый", "Россия", "Спорт", "Кино", "News", "Sport", "Movie", "Kids", "Music", "Discovery",
+          "Матч", "Наш", "Дом", "History", "Travel", "Euro", "Premier", "Баланс", "Мир", "Comedy"]
+_QUERIES = ["спорт", "sport", "perv", "kino hd", "dis", "матч премьер"]
+
+_ILIKE_SQL = (
+    "SELECT playlist_id, tvg_id, name FROM channels WHERE playlist_id = ANY(:ids) "
+    "AND (name ILIKE :s OR tvg_id ILIKE :s OR COALESCE(tvg_name,'') ILIKE :s) ORDER BY grp, name LIMIT 50"
+)
+_TRGM_SQL = (
+    "SELECT playlist_id, tvg_id, name FROM channels WHERE playlist_id = ANY(:ids) AND search_text LIKE :like "
+    "ORDER BY (' ' || search_text) LIKE :word DESC, similarity(search_text, :q) DESC, name LIMIT 50"
+)
+
+
+def _load(playlist_id: str, n: int) -> None:
+    rnd = random.Random(n)
+    rows = []
+    for i in range(n):
+        name = f"{rnd.choice(_WORDS)} {rnd.choice(_WORDS)} {i}" + (" HD" if i % 3 == 0 else "")
+        tvg_id = f"ch{i}.bench"
+        rows.append((playlist_id, tvg_id, name, name, None, rnd.choice(_WORDS), f"http://x/{i}", "",
+                     normalize_search(name, name, tvg_id)))
+    with db() as conn:
+        copy_rows(conn, "channels", ("playlist_id", "tvg_id", "name", "tvg_name", "logo", "grp", "stream_url",
+                                     "raw_extinf", "search_text"), rows)
+        conn.execute(text("ANALYZE channels"))
+
+
+def _time(sql: str, params: dict, repeat: int) -> float:
+    samples = []
+    with db() as conn:
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            conn.execute(text(sql), params).fetchall()
+            samples.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(samples)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 100000])
+    ap.add_argument("--repeat", type=int, default=20)
+    args = ap.parse_args()
+
+    for n in args.sizes:
+        pid = f"pl_bench_{uuid.uuid4().hex[:8]}"
+        _load(pid, n)
+        try:
+            print(f"--- {n} channels (median ms over {args.repeat} runs)")
+            for raw in _QUERIES:
+                q = normalize_search(raw)
+                ilike = _time(_ILIKE_SQL, {"ids": [pid], "s": f"%{raw}%"}, args.repeat)
+                trgm = _time(_TRGM_SQL, {"ids": [pid], "q": q, "like": f"%{q}%", "word": f"% {q}%"}, args.repeat)
+                print(f"{raw!r:>16}: ilike={ilike:8.2f}  trigram={trgm:8.2f}")
+        finally:
+            with db() as conn:
+                conn.execute(text("DELETE FROM channels WHERE playlist_id=:pid"), {"pid": pid})
+
+
+if __name__ == "__main__":
+    main()
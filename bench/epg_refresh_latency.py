@@ -0,0 +1,72 @@
+"""
+API latency while an EPG refresh is running.
+
+    python bench/epg_refresh_latency.py --base http://localhost:8000 \
+        --admin-key $ADMIN_KEY --playlist pl_xxx --seconds 60
+
+Hammers a cheap endpoint (default /api/packages) with --concurrency clients,
+first idle for --seconds, then again while POST /api/admin/playlists/{id}/epg/refresh
+runs, and prints p50/p95/p99 for both phases. Run it once against the old build
+(baseline) and once with EPG_WORKER_MODE=thread / process to compare.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import aiohttp
+
+
+async def _client(session: aiohttp.ClientSession, url: str, stop_at: float, samples: list) -> None:
+    while time.perf_counter() < stop_at:
+        t0 = time.perf_counter()
+        async with session.get(url) as resp:
+            await resp.read()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+
+
+async def _measure(session: aiohttp.ClientSession, url: str, seconds: float, concurrency: int) -> list:
+    samples: list = []
+    stop_at = time.perf_counter() + seconds
+    await asyncio.gather(*(_client(session, url, stop_at, samples) for _ in range(concurrency)))
+    return samples
+
+
+def _report(name: str, samples: list) -> None:
+    if not samples:
+        print(f"{name:>10}: no samples")
+        return
+    q = statistics.quantiles(samples, n=100)
+    print(f"{name:>10}: n={len(samples):6d}  p50={q[49]:8.1f}ms  p95={q[94]:8.1f}ms  p99={q[98]:8.1f}ms  max={max(samples):8.1f}ms")
+
+
+async def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base", default="http://localhost:8000")
+    ap.add_argument("--path", default="/api/packages")
+    ap.add_argument("--admin-key", required=True)
+    ap.add_argument("--playlist", required=True)
+    ap.add_argument("--seconds", type=float, default=30.0)
+    ap.add_argument("--concurrency", type=int, default=16)
+    args = ap.parse_args()
+
+    url = args.base.rstrip("/") + args.path
+    refresh_url = f"{args.base.rstrip('/')}/api/admin/playlists/{args.playlist}/epg/refresh"
+    timeout = aiohttp.ClientTimeout(total=None)
+
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        idle = await _measure(session, url, args.seconds, args.concurrency)
+
+        refresh = asyncio.create_task(session.post(refresh_url, headers={"X-Admin-Key": args.admin_key}))
+        await asyncio.sleep(1.0)  # let the download start
+        busy = await _measure(session, url, args.seconds, args.concurrency)
+        resp = await refresh
+        summary = await resp.json()
+
+    _report("idle", idle)
+    _report("refreshing", busy)
+    print("refresh:", summary)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
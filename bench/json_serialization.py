@@ -0,0 +1,61 @@
+"""
+Serialization cost of a channel list: FastAPI default path vs FastJSONResponse.
+
+    python bench/json_serialization.py
+
+"default" is what a dict-returning endpoint pays: jsonable_encoder + JSONResponse
+(stdlib json). "fast" is FastJSONResponse(payload) returned directly.
+"""
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from app.responses import FastJSONResponse, orjson  # noqa: E402
+
+
+def _payload(n: int) -> dict:
+    t0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return {"items": [
+        {
+            "playlist_id": "pl_0123456789",
+            "tvg_id": f"channel{i}.ru",
+            "name": f"Канал {i} HD",
+            "tvg_name": f"Kanal {i}",
+            "logo": f"https://logos.example.com/{i}.png",
+            "grp": f"Группа {i % 40}",
+            "stream_url": f"http://stream.example.com/live/{i}/index.m3u8",
+            "created_at": t0 + timedelta(minutes=i),
+        }
+        for i in range(n)
+    ]}
+
+
+def _bench(fn, payload, min_time: float = 0.5) -> float:
+    runs, t0 = 0, time.perf_counter()
+    while True:
+        fn(payload)
+        runs += 1
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time:
+            return elapsed / runs * 1000.0
+
+
+def main() -> None:
+    print(f"orjson: {'yes' if orjson is not None else 'no (stdlib fallback)'}")
+    print(f"{'items':>8} {'bytes':>10} {'default ms':>12} {'fast ms':>10} {'saved ms':>10} {'speedup':>8}")
+    for n in (100, 1000, 5000, 20000, 50000):
+        payload = _payload(n)
+        size = len(FastJSONResponse(payload).body)
+        slow = _bench(lambda p: JSONResponse(jsonable_encoder(p)), payload)
+        fast = _bench(lambda p: FastJSONResponse(p), payload)
+        print(f"{n:>8} {size:>10} {slow:>12.2f} {fast:>10.2f} {slow - fast:>10.2f} {slow / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
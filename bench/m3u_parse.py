@@ -0,0 +1,164 @@
+"""
+M3U parsing: the previous list-based parser vs the streaming M3UParser.
+
+    python bench/m3u_parse.py --sizes 1000 10000 100000
+
+"legacy" is the old parse_m3u (splitlines + list of dataclasses) plus the
+separate extract_epg_url scan. "list" is parse_m3u on the new parser, "stream"
+feeds 64 KB byte chunks and only counts channels (how a streamed upload would
+use it). Peak memory is measured with tracemalloc on a separate run.
+"""
+import argparse
+import random
+import re
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.parsers.m3u import M3UParser, parse_m3u  # noqa: E402
+
+_attr_re = re.compile(r'(\w+(?:-\w+)*)="([^"]*)"')
+
+
+@dataclass
+class _LegacyChannel:
+    tvg_id: str
+    name: str
+    tvg_name: Optional[str]
+    logo: Optional[str]
+    grp: Optional[str]
+    stream_url: str
+    raw_extinf: str
+
+
+def _legacy_epg_url(m3u_text: str) -> Optional[str]:
+    for line in m3u_text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXTM3U"):
+            attrs = dict(_attr_re.findall(line))
+            return attrs.get("url-tvg") or attrs.get("x-tvg-url")
+        break
+    return None
+
+
+def _legacy_parse(m3u_text: str) -> List[_LegacyChannel]:
+    lines = [ln.rstrip("\r") for ln in m3u_text.splitlines()]
+    channels = []
+    pending_extinf = pending_attrs = pending_name = pending_grp = None
+
+    def clean(s):
+        if s is None:
+            return None
+        s = s.strip()
+        return s if s else None
+
+    for raw in lines:
+        line = raw.strip()
+        if not line:
+            continue
+        if line.startswith("#EXTINF"):
+            pending_extinf = line
+            attrs = dict(_attr_re.findall(line))
+            disp = line.split(",", 1)[1].strip() if "," in line else ""
+            pending_attrs = attrs
+            pending_name = disp or attrs.get("tvg-name") or attrs.get("tvg-id") or "Channel"
+            if "group-title" in attrs:
+                pending_grp = attrs.get("group-title")
+            continue
+        if line.startswith("#EXTGRP:"):
+            pending_grp = line.split(":", 1)[1].strip() or pending_grp
+            continue
+        if line.startswith("#"):
+            continue
+        if pending_extinf and pending_attrs:
+            tvg_id = pending_attrs.get("tvg-id") or pending_attrs.get("tvgid") or pending_attrs.get("tvg_id")
+            tvg_id = (tvg_id or (pending_attrs.get("tvg-name") or pending_name or "unknown")).strip()
+            channels.append(_LegacyChannel(
+                tvg_id=tvg_id, name=(pending_name or tvg_id).strip(), tvg_name=clean(pending_attrs.get("tvg-name")),
+                logo=clean(pending_attrs.get("tvg-logo")), grp=clean(pending_grp), stream_url=line,
+                raw_extinf=pending_extinf,
+            ))
+        pending_extinf = pending_attrs = pending_name = pending_grp = None
+    return channels
+
+
+def _playlist(n: int) -> str:
+    rnd = random.Random(n)
+    out = ['#EXTM3U url-tvg="http://epg.example.com/guide.xml.gz" tvg-shift="0"']
+    for i in range(n):
+        grp = f"Группа {rnd.randrange(60)}"
+        out.append(f'#EXTINF:-1 tvg-id="ch{i}.example" tvg-name="Канал {i}" '
+                   f'tvg-logo="http://logo.example.com/{i}.png" group-title="{grp}",Канал {i} HD')
+        if i % 7 == 0:
+            out.append(f"#EXTGRP:{grp}")
+        out.append(f"http://stream.example.com:8080/live/user/pass/{i}.ts")
+    return "\r\n".join(out) + "\r\n"
+
+
+def _legacy(text: str) -> int:
+    _legacy_epg_url(text)
+    return len(_legacy_parse(text))
+
+
+def _list(text: str) -> int:
+    return len(parse_m3u(text))
+
+
+def _stream(data: bytes, chunk: int = 64 * 1024) -> int:
+    p = M3UParser()
+    n = 0
+    for i in range(0, len(data), chunk):
+        n += len(p.feed(data[i:i + chunk]))
+    return n + len(p.close())
+
+
+def _time(fn, arg, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000.0
+
+
+def _peak(fn, arg) -> float:
+    tracemalloc.start()
+    fn(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1e6
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    print(f"{'entries':>8} {'MB':>6} | {'legacy ms':>10} {'list ms':>9} {'stream ms':>10} | "
+          f"{'legacy MB':>10} {'list MB':>8} {'stream MB':>10}")
+    for n in args.sizes:
+        text = _playlist(n)
+        data = text.encode("utf-8")
+        # same records, same url-tvg
+        p = M3UParser()
+        streamed = p.feed(data[:len(data) // 3]) + p.feed(data[len(data) // 3:]) + p.close()
+        assert [tuple(vars(c).values()) for c in _legacy_parse(text)] == \
+            [(c.tvg_id, c.name, c.tvg_name, c.logo, c.grp, c.stream_url, c.raw_extinf) for c in streamed]
+        assert p.epg_url == _legacy_epg_url(text)
+
+        times = [_time(_legacy, text, args.repeat), _time(_list, text, args.repeat), _time(_stream, data, args.repeat)]
+        peaks = [_peak(_legacy, text), _peak(_list, text), _peak(_stream, data)]
+        print(f"{n:>8} {len(data) / 1e6:>6.1f} | {times[0]:>10.1f} {times[1]:>9.1f} {times[2]:>10.1f} | "
+              f"{peaks[0]:>10.1f} {peaks[1]:>8.1f} {peaks[2]:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+XMLTV timestamp conversion: previous strptime + ISO string round trip vs parse_xmltv_time.
+
+    python bench/xmltv_timestamps.py --n 200000
+
+Input mimics a real guide: 7 days of 5-30 minute slots for a few hundred
+channels, mostly "+0300" / "+0000" offsets. "legacy" is the old
+_xmltv_to_utc_iso (strptime -> isoformat -> "Z"), "legacy+parse" adds the
+fromisoformat the DB driver/COPY path effectively paid to get a datetime back.
+Caches are cleared before every run.
+"""
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.parsers import xmltv  # noqa: E402
+
+
+def _legacy(dt_str: str) -> str:
+    s = dt_str.strip()
+    if " " in s:
+        main, tz = s.split(" ", 1)
+        s = main + tz
+    main = s[:14]
+    tz = s[14:19] if len(s) >= 19 and s[14] in "+-" else None
+    dt_naive = datetime.strptime(main, "%Y%m%d%H%M%S")
+    if tz:
+        sign = 1 if tz[0] == "+" else -1
+        offset_minutes = sign * (int(tz[1:3]) * 60 + int(tz[3:5]))
+        dt_utc = dt_naive.replace(tzinfo=timezone.utc) - timedelta(minutes=offset_minutes)
+    else:
+        dt_utc = dt_naive.replace(tzinfo=timezone.utc)
+    return dt_utc.isoformat().replace("+00:00", "Z")
+
+
+def _inputs(n: int) -> list:
+    rnd = random.Random(n)
+    start = datetime(2026, 3, 1)
+    out = []
+    while len(out) < n:
+        t = start + timedelta(minutes=5 * rnd.randrange(7 * 24 * 12))
+        if rnd.random() < 0.1:
+            t += timedelta(seconds=rnd.randrange(60))
+        out.append(t.strftime("%Y%m%d%H%M%S") + rnd.choice([" +0300", " +0300", " +0000", " +0200"]))
+    return out
+
+
+def _run(fn, values, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        # cold caches on every run
+        xmltv._recent.clear()
+        xmltv._hours.clear()
+        xmltv._offsets.clear()
+        t0 = time.perf_counter()
+        for v in values:
+            fn(v)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=200000)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    values = _inputs(args.n)
+    for v in values[:1000]:
+        assert xmltv.parse_xmltv_time(v).isoformat().replace("+00:00", "Z") == _legacy(v), v
+
+    cases = [
+        ("legacy", _legacy),
+        ("legacy+parse", lambda v: datetime.fromisoformat(_legacy(v).replace("Z", "+00:00"))),
+        ("parse_xmltv_time", xmltv.parse_xmltv_time),
+    ]
+    base = None
+    print(f"{args.n} timestamps, best of {args.repeat}")
+    for name, fn in cases:
+        secs = _run(fn, values, args.repeat)
+        base = base or secs
+        print(f"{name:>18}: {secs * 1000:9.1f} ms  {secs / args.n * 1e9:7.0f} ns/ts  {base / secs:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()